@@ -1,29 +1,47 @@
-import copy
 import json
 import os
 import logging
 import uuid
+import hashlib
+from functools import wraps
+from types import MappingProxyType
 from dotenv import load_dotenv
 import httpx
-import msal
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 from quart import (
     Blueprint,
     Quart,
+    current_app,
     jsonify,
     make_response,
     request,
+    Response,
     send_from_directory,
     render_template
 )
 # from quart_cors import cors
 from openai import AsyncAzureOpenAI
-from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from azure.identity.aio import ClientSecretCredential, DefaultAzureCredential
 from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 from datetime import datetime, timedelta
 from backend.auth.auth_utils import get_authenticated_user_details
-from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.auth.credentials import CredentialManager
+from backend.history.cosmosdbservice import (
+    CONVERSATION_LIST_FIELDS,
+    MESSAGE_READ_FIELDS,
+    CosmosConversationClientRegistry,
+)
+from backend.history.accesscontrol import AccessControlIndex
+from backend.history.changefeed import ChangeFeedWatcher
+from backend.history.listcache import (
+    ConversationListCache,
+    LocalListCacheBackend,
+    RedisListCacheBackend,
+)
+from backend.history.writebehind import HistoryWriteQueue
+from backend.http_clients import HttpClientPool
+from backend.serialization import FastJSONProvider
+from backend.cache import TTLCache
 
 from backend.utils import (
     format_as_ndjson,
@@ -33,6 +51,8 @@ from backend.utils import (
     format_non_streaming_response,
     convert_to_pf_format,
     format_pf_non_streaming_response,
+    redact_secrets,
+    STREAM_V2_MIMETYPE,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
@@ -58,12 +78,28 @@ UI_SHOW_SHARE_BUTTON = os.environ.get("UI_SHOW_SHARE_BUTTON", "true").lower() ==
 AZURE_TENANT_ID=os.environ['AZURE_TENANT_ID']
 AZURE_CLIENT_ID=os.environ['AZURE_CLIENT_ID']
 AZURE_CLIENT_SECRET=os.environ['AZURE_CLIENT_SECRET']
-AUTHORITY = f"https://login.microsoftonline.com/{AZURE_TENANT_ID}"
 SCOPES = ["https://graph.microsoft.com/.default"]
+AZURE_OPENAI_TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+MS_GRAPH_ENDPOINT = "https://graph.microsoft.com/v1.0"
+MS_GRAPH_TIMEOUT = os.environ.get("MS_GRAPH_TIMEOUT", 10.0)
+# Group memberships change rarely, so Graph lookups are cached per user
+GRAPH_GROUP_CACHE_SIZE = os.environ.get("GRAPH_GROUP_CACHE_SIZE", 1024)
+GRAPH_GROUP_CACHE_TTL = os.environ.get("GRAPH_GROUP_CACHE_TTL", 300)
+GRAPH_GROUP_CACHE_NEGATIVE_TTL = os.environ.get("GRAPH_GROUP_CACHE_NEGATIVE_TTL", 30)
+graph_group_cache = TTLCache(
+    maxsize=int(GRAPH_GROUP_CACHE_SIZE),
+    ttl=float(GRAPH_GROUP_CACHE_TTL),
+    negative_ttl=float(GRAPH_GROUP_CACHE_NEGATIVE_TTL),
+)
+# Search security filters, reused per user token until the token expires
+search_filter_cache = TTLCache(maxsize=int(GRAPH_GROUP_CACHE_SIZE))
+# Cached AAD tokens are refreshed this many seconds before they expire
+AZURE_TOKEN_REFRESH_MARGIN = os.environ.get("AZURE_TOKEN_REFRESH_MARGIN", 300)
 
 
 def create_app():
     app = Quart(__name__)
+    app.json = FastJSONProvider(app)
     # app = cors(app, allow_origin="*")
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
@@ -142,12 +178,21 @@ AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get(
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION,
 )
 AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
+# Merge streamed content deltas into frames of at most this many ms / bytes (0 ms disables it)
+STREAM_COALESCE_INTERVAL_MS = os.environ.get("STREAM_COALESCE_INTERVAL_MS", 0)
+STREAM_COALESCE_MAX_BYTES = os.environ.get("STREAM_COALESCE_MAX_BYTES", 1024)
 AZURE_OPENAI_MODEL_NAME = os.environ.get(
     "AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo-16k"
 )  # Name of the model, e.g. 'gpt-35-turbo-16k' or 'gpt-4'
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
+# Connection pool of the worker-wide Azure OpenAI client
+AZURE_OPENAI_MAX_CONNECTIONS = os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100)
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = os.environ.get(
+    "AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20
+)
+AZURE_OPENAI_KEEPALIVE_EXPIRY = os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30.0)
 
 
 #Azure Storage Container
@@ -204,6 +249,40 @@ AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = (
     os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "false").lower() == "true"
 )
+# Optional write-behind queue for message, conversation and feedback writes
+AZURE_COSMOSDB_WRITE_BEHIND = (
+    os.environ.get("AZURE_COSMOSDB_WRITE_BEHIND", "false").lower() == "true"
+)
+AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL = os.environ.get(
+    "AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL", 0.2
+)
+# Indexing policy of the conversations container at startup: off, check (log differences) or apply
+AZURE_COSMOSDB_INDEXING_POLICY = os.environ.get("AZURE_COSMOSDB_INDEXING_POLICY", "check").lower()
+# Bulk deletes of chat history
+AZURE_COSMOSDB_DELETE_CONCURRENCY = os.environ.get("AZURE_COSMOSDB_DELETE_CONCURRENCY", 5)
+# delete_all runs in the background for users with more conversations than this
+HISTORY_DELETE_ALL_SYNC_LIMIT = os.environ.get("HISTORY_DELETE_ALL_SYNC_LIMIT", 50)
+# Cache of the /history/list pages per user, shared across workers when a Redis URL is set
+# It is on by default only with Redis; an in-process cache is not invalidated by the writes of the other workers
+HISTORY_LIST_CACHE_REDIS_URL = os.environ.get("HISTORY_LIST_CACHE_REDIS_URL")
+HISTORY_LIST_CACHE = (
+    os.environ.get("HISTORY_LIST_CACHE") or ("true" if HISTORY_LIST_CACHE_REDIS_URL else "false")
+).lower() == "true"
+HISTORY_LIST_CACHE_TTL = os.environ.get("HISTORY_LIST_CACHE_TTL", 30)
+# Server-side cache of /useCase/name_list, invalidated from the change feed of the use case container
+USECASE_LIST_CACHE_TTL = os.environ.get("USECASE_LIST_CACHE_TTL", 300)
+USECASE_LIST_MAX_AGE = os.environ.get("USECASE_LIST_MAX_AGE", 0)
+CHANGE_FEED_POLL_INTERVAL = os.environ.get("CHANGE_FEED_POLL_INTERVAL", 30)
+usecase_list_cache = TTLCache(maxsize=256, ttl=float(USECASE_LIST_CACHE_TTL))
+# History containers the clients may name besides the conversations container and the use cases, comma separated
+AZURE_COSMOSDB_ALLOWED_CONTAINERS = os.environ.get("AZURE_COSMOSDB_ALLOWED_CONTAINERS", "")
+# In-memory index of the access control and use case containers, fully reloaded every interval
+ACCESS_CONTROL_INDEX = os.environ.get("ACCESS_CONTROL_INDEX", "true").lower() == "true"
+ACCESS_CONTROL_INDEX_RELOAD_INTERVAL = os.environ.get("ACCESS_CONTROL_INDEX_RELOAD_INTERVAL", 3600)
+# Conversation titles are generated in the background, a few at a time per worker
+TITLE_LOCAL_WORD_COUNT = int(os.environ.get("TITLE_LOCAL_WORD_COUNT", 6))
+TITLE_GENERATION_CONCURRENCY = int(os.environ.get("TITLE_GENERATION_CONCURRENCY", 2))
+title_generation_semaphore = asyncio.Semaphore(TITLE_GENERATION_CONCURRENCY)
 ENABLE_ACCESS_CONTROL = True if os.environ['ENABLE_ACCESS_CONTROL'].lower()=="true" else False
 AZURE_COSMOSDB_ACCESS_CONTROL_DATABASE = os.environ.get("CosmosAccessControlDataBaseName")
 AZURE_COSMOSDB_TECH_HUB_CONTAINER = os.environ.get("AzureCosmosDBTechHubContainer")
@@ -267,6 +346,9 @@ PROMPTFLOW_REQUEST_FIELD_NAME = os.environ.get("PROMPTFLOW_REQUEST_FIELD_NAME",
 PROMPTFLOW_RESPONSE_FIELD_NAME = os.environ.get(
     "PROMPTFLOW_RESPONSE_FIELD_NAME", "reply"
 )
+# Connection pool of each shared upstream HTTP client (Microsoft Graph, promptflow)
+HTTP_MAX_CONNECTIONS = os.environ.get("HTTP_MAX_CONNECTIONS", 20)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 10)
 # Frontend Settings via Environment Variables
 AUTH_ENABLED = os.environ.get("AUTH_ENABLED", "true").lower() == "true"
 CHAT_HISTORY_ENABLED = (
@@ -358,8 +440,8 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
-            ad_token_provider = get_bearer_token_provider(
-                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+            ad_token_provider = current_app.credential_manager.get_bearer_token_provider(
+                AZURE_OPENAI_TOKEN_SCOPE
             )
 
         # Deployment
@@ -370,12 +452,23 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
+        # Connection pool, kept alive between requests served by this worker
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(AZURE_OPENAI_MAX_CONNECTIONS),
+                max_keepalive_connections=int(AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS),
+                keepalive_expiry=float(AZURE_OPENAI_KEEPALIVE_EXPIRY),
+            ),
+            follow_redirects=True,
+        )
+
         azure_openai_client = AsyncAzureOpenAI(
             api_version=AZURE_OPENAI_PREVIEW_API_VERSION,
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=http_client,
         )
 
         return azure_openai_client
@@ -385,8 +478,8 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         raise e
 
 
-def init_cosmosdb_client(container_name, database_name = None):
-    cosmos_conversation_client = None
+def init_cosmosdb_registry():
+    cosmos_registry = None
     if CHAT_HISTORY_ENABLED:
         try:
             cosmos_endpoint = (
@@ -394,60 +487,300 @@ def init_cosmosdb_client(container_name, database_name = None):
             )
 
             if not AZURE_COSMOSDB_ACCOUNT_KEY:
-                credential = DefaultAzureCredential()
+                credential = current_app.credential_manager.get_credential()
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
-            cosmos_conversation_client = CosmosConversationClient(
+            write_queue = None
+            if AZURE_COSMOSDB_WRITE_BEHIND:
+                write_queue = HistoryWriteQueue(
+                    flush_interval=float(AZURE_COSMOSDB_WRITE_BEHIND_FLUSH_INTERVAL)
+                )
+
+            cosmos_registry = CosmosConversationClientRegistry(
                 cosmosdb_endpoint=cosmos_endpoint,
                 credential=credential,
                 database_name=AZURE_COSMOSDB_DATABASE,
-                container_name=container_name, #AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
                 enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                write_queue=write_queue,
+                delete_concurrency=int(AZURE_COSMOSDB_DELETE_CONCURRENCY),
             )
-            print(cosmos_conversation_client)
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
-            cosmos_conversation_client = None
+            cosmos_registry = None
             raise e
     else:
         logging.debug("CosmosDB not configured")
 
+    return cosmos_registry
+
+
+def init_cosmosdb_client(container_name, database_name = None):
+    cosmos_conversation_client = None
+    if CHAT_HISTORY_ENABLED and current_app.cosmos_registry:
+        cosmos_conversation_client = current_app.cosmos_registry.get_client(
+            container_name, database_name
+        )
+    else:
+        logging.debug("CosmosDB not configured")
+
     return cosmos_conversation_client
 
+async def get_history_container_names():
+    ## names of all use cases, cached with the use case lists and cleared by the same change feed
+    async def load_names():
+        access_control_index = current_app.access_control_index
+        if access_control_index:
+            return frozenset(access_control_index.get_all_usecase_names())
+        usecase_client = init_cosmosdb_client(AZURE_USECASE_COSMOSDB_QUERY_CONTAINER)
+        if not usecase_client:
+            raise Exception("The use case container is not configured or not working")
+        return frozenset(await usecase_client.get_all_usecase_names())
+
+    return await usecase_list_cache.get_or_load((get_usecase_list_version(), "containers"), load_names)
+
+
+async def is_allowed_container(container_name):
+    ## history containers are named after the use cases; other names never get a client
+    if container_name == AZURE_COSMOSDB_CONVERSATIONS_CONTAINER:
+        return True
+    if AZURE_COSMOSDB_ALLOWED_CONTAINERS and container_name in parse_multi_columns(AZURE_COSMOSDB_ALLOWED_CONTAINERS):
+        return True
+    if not AZURE_USECASE_COSMOSDB_QUERY_CONTAINER:
+        return False
+    return container_name in await get_history_container_names()
+
+
+def history_container_route(route):
+    ## rejects a containerName (query string or JSON body) that is not a chat history container
+    @wraps(route)
+    async def check_container_name(*args, **kwargs):
+        container_name = request.args.get("containerName", None)
+        if container_name is None and request.is_json:
+            request_json = await request.get_json(silent=True)
+            if isinstance(request_json, dict):
+                container_name = request_json.get("containerName", None)
+        if container_name is not None:
+            try:
+                allowed = await is_allowed_container(container_name)
+            except Exception:
+                logging.exception("Exception while checking the chat history container")
+                return jsonify({"error": "Unable to verify the chat history container"}), 503
+            if not allowed:
+                return jsonify({"error": f"{container_name} is not a chat history container"}), 400
+        return await route(*args, **kwargs)
+
+    return check_container_name
+
+
 # For Access Control Checks
 def init_cosmosdb_access_control(container_name, database_name):
-    cosmos_access_control_client = None
-    if CHAT_HISTORY_ENABLED:
-        try:
-            cosmos_endpoint = (
-                f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/"
-            )
+    return init_cosmosdb_client(container_name, database_name)
 
-            if not AZURE_COSMOSDB_ACCOUNT_KEY:
-                credential = DefaultAzureCredential()
-            else:
-                credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
-            cosmos_access_control_client = CosmosConversationClient(
-                cosmosdb_endpoint=cosmos_endpoint,
-                credential=credential,
-                database_name=database_name,
-                container_name=container_name,
-                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
-            )
-        except Exception as e:
-            logging.exception("Exception in CosmosDB initialization", e)
-            cosmos_access_control_client = None
-            raise e
+def init_credential_manager():
+    # One credential chain per worker; tokens are cached and refreshed in the background
+    credential_manager = CredentialManager(
+        default_credential=DefaultAzureCredential(),
+        refresh_margin=int(AZURE_TOKEN_REFRESH_MARGIN),
+    )
+    # App-only Microsoft Graph token for group lookups, acquired without blocking a thread
+    credential_manager.register(
+        SCOPES[0],
+        ClientSecretCredential(AZURE_TENANT_ID, AZURE_CLIENT_ID, AZURE_CLIENT_SECRET),
+    )
+    if ENABLE_ACCESS_CONTROL:
+        credential_manager.start(SCOPES[0])
+    return credential_manager
+
+
+def init_http_clients():
+    http_clients = HttpClientPool(
+        max_connections=int(HTTP_MAX_CONNECTIONS),
+        max_keepalive_connections=int(HTTP_MAX_KEEPALIVE_CONNECTIONS),
+    )
+    http_clients.configure(MS_GRAPH_ENDPOINT, timeout=float(MS_GRAPH_TIMEOUT))
+    if PROMPTFLOW_ENDPOINT:
+        # Adding timeout for scenarios where response takes longer to come back
+        http_clients.configure(
+            PROMPTFLOW_ENDPOINT, timeout=float(PROMPTFLOW_RESPONSE_TIMEOUT)
+        )
+    return http_clients
+
+
+def init_history_list_cache():
+    if not HISTORY_LIST_CACHE:
+        return None
+
+    if HISTORY_LIST_CACHE_REDIS_URL:
+        backend = RedisListCacheBackend(HISTORY_LIST_CACHE_REDIS_URL)
     else:
-        logging.debug("CosmosDB not configured")
+        backend = LocalListCacheBackend()
+    return ConversationListCache(backend, ttl=float(HISTORY_LIST_CACHE_TTL))
 
-    return cosmos_access_control_client
 
-def get_configured_data_source(request_body):
-    # print("-------------------------------------------------------------------")
-    # print(request_body)
+@bp.before_app_serving
+async def init_clients():
+    current_app.credential_manager = init_credential_manager()
+    current_app.http_clients = init_http_clients()
+
+    # One Azure OpenAI client per worker, shared by every request
+    try:
+        current_app.azure_openai_client = init_openai_client()
+    except Exception:
+        logging.exception("Azure OpenAI client could not be initialized")
+        current_app.azure_openai_client = None
+
+    # One CosmosClient per worker, shared by every history and use case container
+    try:
+        current_app.cosmos_registry = init_cosmosdb_registry()
+    except Exception:
+        logging.exception("CosmosDB client could not be initialized")
+        current_app.cosmos_registry = None
+
+    current_app.change_feed_watchers = {}
+    try:
+        current_app.access_control_index = await init_access_control_index()
+    except Exception:
+        logging.exception("Access control index could not be loaded")
+        current_app.access_control_index = None
+
+    try:
+        watch_usecases()
+    except Exception:
+        logging.exception("Change feed of the use case container could not be watched")
+
+    try:
+        current_app.history_list_cache = init_history_list_cache()
+    except Exception:
+        logging.exception("Conversation list cache could not be initialized")
+        current_app.history_list_cache = None
+
+    await check_indexing_policy()
+
+
+def get_change_feed_watcher(container_name, database_name=None):
+    # One poller per container and worker, shared by every cache that depends on it
+    key = (database_name, container_name)
+    watcher = current_app.change_feed_watchers.get(key)
+    if not watcher:
+        cosmos_client = current_app.cosmos_registry.get_client(container_name, database_name)
+        watcher = ChangeFeedWatcher(
+            cosmos_client.container_client, interval=float(CHANGE_FEED_POLL_INTERVAL)
+        )
+        watcher.start()
+        current_app.change_feed_watchers[key] = watcher
+    return watcher
+
+
+async def init_access_control_index():
+    if (
+        not ACCESS_CONTROL_INDEX
+        or not current_app.cosmos_registry
+        or not AZURE_USECASE_COSMOSDB_QUERY_CONTAINER
+    ):
+        return None
+
+    usecase_client = init_cosmosdb_client(AZURE_USECASE_COSMOSDB_QUERY_CONTAINER)
+    access_control_client = None
+    if ENABLE_ACCESS_CONTROL and AZURE_COSMOSDB_TECH_HUB_CONTAINER:
+        access_control_client = init_cosmosdb_access_control(
+            AZURE_COSMOSDB_TECH_HUB_CONTAINER, AZURE_COSMOSDB_ACCESS_CONTROL_DATABASE
+        )
+
+    access_control_index = AccessControlIndex(
+        access_control_container=access_control_client.container_client if access_control_client else None,
+        usecase_container=usecase_client.container_client,
+        reload_interval=float(ACCESS_CONTROL_INDEX_RELOAD_INTERVAL),
+    )
+    # The change feed is watched from before the full load, so no change falls in between
+    get_change_feed_watcher(AZURE_USECASE_COSMOSDB_QUERY_CONTAINER).add_listener(
+        access_control_index.apply_usecase_changes
+    )
+    if access_control_client:
+        get_change_feed_watcher(
+            AZURE_COSMOSDB_TECH_HUB_CONTAINER, AZURE_COSMOSDB_ACCESS_CONTROL_DATABASE
+        ).add_listener(access_control_index.apply_access_control_changes)
+
+    await access_control_index.load()
+    access_control_index.start()
+    return access_control_index
+
+
+def watch_usecases():
+    if not current_app.cosmos_registry or not AZURE_USECASE_COSMOSDB_QUERY_CONTAINER:
+        return
+    watcher = get_change_feed_watcher(AZURE_USECASE_COSMOSDB_QUERY_CONTAINER)
+    watcher.add_listener(lambda changed: usecase_list_cache.clear())
+
+
+def get_usecase_list_version():
+    # Bumped by every change in the use case container, so cached lists never outlive a change
+    watcher = current_app.change_feed_watchers.get((None, AZURE_USECASE_COSMOSDB_QUERY_CONTAINER))
+    return watcher.version if watcher else 0
+
+
+async def check_indexing_policy():
+    if (
+        not current_app.cosmos_registry
+        or not AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+        or AZURE_COSMOSDB_INDEXING_POLICY == "off"
+    ):
+        return
+
+    # Per use case containers are provisioned with scripts/cosmos_indexing_policy.py
+    try:
+        cosmos_conversation_client = init_cosmosdb_client(AZURE_COSMOSDB_CONVERSATIONS_CONTAINER)
+        await cosmos_conversation_client.check_indexing_policy(
+            apply=AZURE_COSMOSDB_INDEXING_POLICY == "apply"
+        )
+    except Exception:
+        logging.exception("Indexing policy of the CosmosDB conversations container could not be checked")
+
+
+@bp.after_app_serving
+async def close_clients():
+    for watcher in current_app.change_feed_watchers.values():
+        await watcher.close()
+    if current_app.access_control_index:
+        await current_app.access_control_index.close()
+    if current_app.azure_openai_client:
+        await current_app.azure_openai_client.close()
+    if current_app.cosmos_registry:
+        await current_app.cosmos_registry.close()
+    if current_app.history_list_cache:
+        await current_app.history_list_cache.close()
+    await current_app.http_clients.close()
+    await current_app.credential_manager.close()
+
+
+def get_azure_openai_client():
+    azure_openai_client = current_app.azure_openai_client
+    if not azure_openai_client:
+        raise Exception("Azure OpenAI client is not configured or not working")
+    return azure_openai_client
+
+
+def freeze_config(value):
+    # Read-only copy of nested dicts and lists, shared by every request without copying
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze_config(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze_config(v) for v in value)
+    return value
+
+
+def thaw_config(mapping):
+    # Plain dicts for the SDK's JSON encoder; tuples and scalars are shared with the template
+    return {
+        k: thaw_config(v) if isinstance(v, MappingProxyType) else v
+        for k, v in mapping.items()
+    }
+
+
+def build_data_source_template():
+    # Everything but the index name and security filter of Azure AI Search is
+    # request independent, so it is parsed and validated once at startup
     data_source = {}
     query_type = "simple"
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
@@ -460,20 +793,6 @@ def get_configured_data_source(request_body):
         ):
             query_type = "semantic"
 
-        # Set filter
-        filter = None
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
-            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-            if not userToken:
-                raise Exception(
-                    "Document-level access control is enabled, but user access token could not be fetched."
-                )
-
-            filter = generateFilterString(userToken)
-            logging.debug(f"FILTER: {filter}")
-
         # Set authentication
         authentication = {}
         if AZURE_SEARCH_KEY:
@@ -487,7 +806,8 @@ def get_configured_data_source(request_body):
             "parameters": {
                 "endpoint": f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
                 "authentication": authentication,
-                "index_name": request_body["indexName"],
+                # Set per request
+                "index_name": None,
                 "fields_mapping": {
                     "content_fields": (
                         parse_multi_columns(AZURE_SEARCH_CONTENT_COLUMNS)
@@ -524,7 +844,8 @@ def get_configured_data_source(request_body):
                     else ""
                 ),
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "filter": filter,
+                # Set per request
+                "filter": None,
                 "strictness": (
                     int(AZURE_SEARCH_STRICTNESS)
                     if AZURE_SEARCH_STRICTNESS
@@ -773,10 +1094,57 @@ def get_configured_data_source(request_body):
             )
         data_source["parameters"]["embedding_dependency"] = embeddingDependency
 
+    return freeze_config(data_source)
+
+
+# Read-only; a configuration error fails the worker at boot instead of the first request
+DATA_SOURCE_TEMPLATE = build_data_source_template() if SHOULD_USE_DATA else None
+
+
+async def get_configured_data_source(request_body):
+    if not DATA_SOURCE_TEMPLATE:
+        raise Exception(
+            f"DATASOURCE_TYPE is not configured or unknown: {DATASOURCE_TYPE}"
+        )
+
+    # the template is frozen, so only its mappings are copied; lists are shared as tuples
+    data_source = {
+        "type": DATA_SOURCE_TEMPLATE["type"],
+        "parameters": thaw_config(DATA_SOURCE_TEMPLATE["parameters"]),
+    }
+    if DATASOURCE_TYPE == "AzureCognitiveSearch":
+        data_source["parameters"]["index_name"] = request_body["indexName"]
+        data_source["parameters"]["filter"] = await get_search_filter()
+
     return data_source
 
 
-def prepare_model_args(request_body):
+async def get_search_filter():
+    if not AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        return None
+
+    userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+    logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+    if not userToken:
+        raise Exception(
+            "Document-level access control is enabled, but user access token could not be fetched."
+        )
+
+    user_id = get_authenticated_user_details(request_headers=request.headers)[
+        "user_principal_id"
+    ]
+    filter = await generateFilterString(
+        userToken,
+        current_app.http_clients.get_client(MS_GRAPH_ENDPOINT),
+        group_cache=graph_group_cache,
+        cache_key=("me", user_id),
+        filter_cache=search_filter_cache,
+    )
+    logging.debug(f"FILTER: {filter}")
+    return filter
+
+
+async def prepare_model_args(request_body):
     request_messages = request_body.get("messages", [])
     messages = []
     if not SHOULD_USE_DATA:
@@ -802,43 +1170,18 @@ def prepare_model_args(request_body):
     # print("-------------------------------------------------------------------")
     # print(request_body)
     if SHOULD_USE_DATA:
-        model_args["extra_body"] = {"data_sources": [get_configured_data_source(request_body)]}
-
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+        model_args["extra_body"] = {"data_sources": [await get_configured_data_source(request_body)]}
+
+    # Only pay for redaction and serialization when debug logging is on;
+    # the messages are shared with model_args rather than copied
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        model_args_clean = model_args
+        if model_args.get("extra_body"):
+            model_args_clean = {
+                **model_args,
+                "extra_body": redact_secrets(model_args["extra_body"]),
+            }
+        logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
 
     return model_args
 
@@ -849,26 +1192,22 @@ async def promptflow_request(request):
             "Content-Type": "application/json",
             "Authorization": f"Bearer {PROMPTFLOW_API_KEY}",
         }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {PROMPTFLOW_RESPONSE_TIMEOUT}")
-        async with httpx.AsyncClient(
-            timeout=float(PROMPTFLOW_RESPONSE_TIMEOUT)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request, PROMPTFLOW_REQUEST_FIELD_NAME, PROMPTFLOW_RESPONSE_FIELD_NAME
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
-                PROMPTFLOW_ENDPOINT,
-                json={
-                    f"{PROMPTFLOW_REQUEST_FIELD_NAME}": pf_formatted_obj[-1]["inputs"][
-                        PROMPTFLOW_REQUEST_FIELD_NAME
-                    ],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
-                headers=headers,
-            )
+        client = current_app.http_clients.get_client(PROMPTFLOW_ENDPOINT)
+        pf_formatted_obj = convert_to_pf_format(
+            request, PROMPTFLOW_REQUEST_FIELD_NAME, PROMPTFLOW_RESPONSE_FIELD_NAME
+        )
+        # NOTE: This only support question and chat_history parameters
+        # If you need to add more parameters, you need to modify the request body
+        response = await client.post(
+            PROMPTFLOW_ENDPOINT,
+            json={
+                f"{PROMPTFLOW_REQUEST_FIELD_NAME}": pf_formatted_obj[-1]["inputs"][
+                    PROMPTFLOW_REQUEST_FIELD_NAME
+                ],
+                "chat_history": pf_formatted_obj[:-1],
+            },
+            headers=headers,
+        )
         resp = response.json()
         resp["id"] = request["messages"][-1]["id"]
         return resp
@@ -877,10 +1216,10 @@ async def promptflow_request(request):
 
 
 async def send_chat_request(request):
-    model_args = prepare_model_args(request)
+    model_args = await prepare_model_args(request)
 
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = get_azure_openai_client()
         response = await azure_openai_client.chat.completions.create(**model_args)
 
     except Exception as e:
@@ -903,30 +1242,61 @@ async def complete_chat_request(request_body):
         return format_non_streaming_response(response, history_metadata)
 
 
-async def stream_chat_request(request_body):
+async def stream_chat_request(request_body, history_write=None, stream_version=1):
     response = await send_chat_request(request_body)
     history_metadata = request_body.get("history_metadata", {})
 
+    if history_write:
+        try:
+            await history_write
+        except Exception:
+            await response.close()
+            raise
+
     async def generate():
         async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata)
+            yield format_stream_response(completionChunk, history_metadata, stream_version=stream_version)
 
     return generate()
 
 
-async def conversation_internal(request_body):
+def get_stream_version():
+    ## clients opt in to the compact v2 stream with its Accept type or ?stream_format=v2
+    if request.args.get("stream_format") == "v2":
+        return 2
+    if any(mimetype == STREAM_V2_MIMETYPE and quality > 0 for mimetype, quality in request.accept_mimetypes):
+        return 2
+    return 1
+
+
+async def conversation_internal(request_body, history_write=None):
+    # history_write stores the user message concurrently with the chat request. It
+    # is always awaited before answering, so its errors are reported and a later
+    # /history/update can't overtake it
     try:
         if SHOULD_STREAM:
-            result = await stream_chat_request(request_body)
-            response = await make_response(format_as_ndjson(result))
+            stream_version = get_stream_version()
+            result = await stream_chat_request(request_body, history_write, stream_version)
+            response = await make_response(
+                format_as_ndjson(
+                    result,
+                    coalesce_interval_ms=float(STREAM_COALESCE_INTERVAL_MS),
+                    coalesce_max_bytes=int(STREAM_COALESCE_MAX_BYTES),
+                    stream_version=stream_version,
+                )
+            )
             response.timeout = None
-            response.mimetype = "application/json-lines"
+            response.mimetype = STREAM_V2_MIMETYPE if stream_version == 2 else "application/json-lines"
             return response
         else:
             result = await complete_chat_request(request_body)
+            if history_write:
+                await history_write
             return jsonify(result)
     except Exception as ex:
         logging.exception(ex)
+        if history_write and not history_write.done():
+            await asyncio.gather(history_write, return_exceptions=True)
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
@@ -953,6 +1323,7 @@ def get_frontend_settings():
 
 ## Conversation History API ##
 @bp.route("/history/generate", methods=["POST"])
+@history_container_route
 async def add_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -969,51 +1340,93 @@ async def add_conversation():
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        # check for the conversation_id, if the conversation is not set, we will create a new one
-        history_metadata = {}
-        if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
-            conversation_id = conversation_dict["id"]
-            history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
-            print(conversation_dict)
-
         ## Format the incoming message object in the "chat/completions" messages format
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
-            )
-            if createdMessageValue == "Conversation not found":
-                raise Exception(
-                    "Conversation not found for the given conversation ID: "
-                    + conversation_id
-                    + "."
-                )
-        else:
+        if not (len(messages) > 0 and messages[-1]["role"] == "user"):
             raise Exception("No user message found")
 
-        await cosmos_conversation_client.cosmosdb_client.close()
+        # check for the conversation_id, if the conversation is not set, we will create a new one
+        history_metadata = {}
+        new_conversation = not conversation_id
+        if new_conversation:
+            # start with a cheap local title; the generated one replaces it in the background
+            conversation_id = str(uuid.uuid4())
+            history_metadata["title"] = generate_local_title(messages)
+            history_metadata["date"] = datetime.utcnow().isoformat()
+
+        # Persist the user message while the chat completion is being started
+        history_write = asyncio.create_task(
+            save_user_message(
+                cosmos_conversation_client,
+                user_id,
+                conversation_id,
+                messages,
+                history_metadata,
+                new_conversation,
+            )
+        )
 
         # Submit request to Chat Completions for response
-        request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
-        request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body)
+        request_json["history_metadata"] = history_metadata
+        return await conversation_internal(request_json, history_write=history_write)
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
 
 
+async def save_user_message(
+    cosmos_conversation_client,
+    user_id,
+    conversation_id,
+    messages,
+    history_metadata,
+    new_conversation,
+):
+    if new_conversation:
+        await cosmos_conversation_client.create_conversation(
+            user_id=user_id,
+            title=history_metadata["title"],
+            conversation_id=conversation_id,
+            created_at=history_metadata["date"],
+        )
+        current_app.add_background_task(
+            update_generated_title,
+            cosmos_conversation_client,
+            user_id,
+            conversation_id,
+            history_metadata["title"],
+            messages,
+            history_metadata,
+        )
+
+    createdMessageValue = await cosmos_conversation_client.create_message(
+        uuid=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message=messages[-1],
+    )
+    if createdMessageValue == "Conversation not found":
+        raise Exception(
+            "Conversation not found for the given conversation ID: "
+            + conversation_id
+            + "."
+        )
+    await invalidate_conversation_list(cosmos_conversation_client, user_id)
+
+
+async def invalidate_conversation_list(cosmos_conversation_client, user_id):
+    ## called by every write that changes what /history/list returns for the user
+    if current_app.history_list_cache:
+        await current_app.history_list_cache.invalidate(
+            cosmos_conversation_client.container_name, user_id
+        )
+
+
 @bp.route("/history/update", methods=["POST"])
+@history_container_route
 async def update_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -1037,26 +1450,33 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            input_messages = []
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
-                await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
+                input_messages.append((str(uuid.uuid4()), messages[-2]))
             # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+            input_messages.append((messages[-1]["id"], messages[-1]))
+
+            ## one transactional batch for the messages and the conversation's updatedAt
+            result = await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=input_messages,
             )
+            await invalidate_conversation_list(cosmos_conversation_client, user_id)
+            if result == "Conversation not found":
+                return (
+                    jsonify(
+                        {
+                            "error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."
+                        }
+                    ),
+                    404,
+                )
         else:
             raise Exception("No bot messages found")
 
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -1066,6 +1486,7 @@ async def update_conversation():
 
 
 @bp.route("/history/message_feedback", methods=["POST"])
+@history_container_route
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -1113,6 +1534,7 @@ async def update_message():
 
 
 @bp.route("/history/delete", methods=["DELETE"])
+@history_container_route
 async def delete_conversation():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -1141,8 +1563,7 @@ async def delete_conversation():
         deleted_conversation = await cosmos_conversation_client.delete_conversation(
             user_id, conversation_id
         )
-
-        await cosmos_conversation_client.cosmosdb_client.close()
+        await invalidate_conversation_list(cosmos_conversation_client, user_id)
 
         return (
             jsonify(
@@ -1159,8 +1580,10 @@ async def delete_conversation():
 
 
 @bp.route("/history/list", methods=["GET"])
+@history_container_route
 async def list_conversations():
     offset = request.args.get("offset", 0)
+    cursor = request.args.get("cursor", None)
     container_name = request.args.get("containerName", None)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -1170,20 +1593,63 @@ async def list_conversations():
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversations from cosmos
-    conversations = await cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
-    await cosmos_conversation_client.cosmosdb_client.close()
+    try:
+        offset = int(offset)
+    except ValueError:
+        return jsonify({"error": "offset must be an integer"}), 400
+
+    ## get the conversations from the list cache, or from cosmos
+    ## the first page and cursor requests use continuation tokens, a non-zero offset keeps the old OFFSET query
+    history_list_cache = current_app.history_list_cache
+    use_cursor = bool(cursor) or not offset
+    page = f"cursor:{cursor or ''}" if use_cursor else f"offset:{offset}"
+    cached_page = None
+    generation = None
+    if history_list_cache:
+        generation = await history_list_cache.generation(
+            cosmos_conversation_client.container_name, user_id
+        )
+    if generation is not None:
+        cached_page = await history_list_cache.get(
+            cosmos_conversation_client.container_name, user_id, generation, page
+        )
+
+    if cached_page:
+        conversations, next_cursor = cached_page["conversations"], cached_page["next_cursor"]
+    else:
+        next_cursor = None
+        if use_cursor:
+            try:
+                conversations, next_cursor = await cosmos_conversation_client.get_conversations_page(
+                    user_id, limit=25, cursor=cursor, fields=CONVERSATION_LIST_FIELDS
+                )
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        else:
+            conversations = await cosmos_conversation_client.get_conversations(
+                user_id, offset=offset, limit=25, fields=CONVERSATION_LIST_FIELDS
+            )
+        if generation is not None and isinstance(conversations, list):
+            await history_list_cache.set(
+                cosmos_conversation_client.container_name,
+                user_id,
+                generation,
+                page,
+                {"conversations": conversations, "next_cursor": next_cursor},
+            )
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-    ## return the conversation ids
+    ## return the conversation ids, and the cursor of the next page in a header
 
-    return jsonify(conversations), 200
+    response = jsonify(conversations)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response, 200
 
 
 @bp.route("/history/read", methods=["POST"])
+@history_container_route
 async def get_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -1218,7 +1684,7 @@ async def get_conversation():
 
     # get the messages for the conversation from cosmos
     conversation_messages = await cosmos_conversation_client.get_messages(
-        user_id, conversation_id
+        user_id, conversation_id, fields=MESSAGE_READ_FIELDS
     )
 
     ## format the messages in the bot frontend format
@@ -1233,11 +1699,11 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
+@history_container_route
 async def rename_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
@@ -1255,11 +1721,16 @@ async def rename_conversation():
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversation from cosmos
-    conversation = await cosmos_conversation_client.get_conversation(
-        user_id, conversation_id
+    title = request_json.get("title", None)
+    if not title:
+        return jsonify({"error": "title is required"}), 400
+
+    ## patch the title in place instead of reading and rewriting the conversation
+    updated_conversation = await cosmos_conversation_client.update_conversation_title(
+        user_id, conversation_id, title
     )
-    if not conversation:
+    await invalidate_conversation_list(cosmos_conversation_client, user_id)
+    if not updated_conversation:
         return (
             jsonify(
                 {
@@ -1269,20 +1740,11 @@ async def rename_conversation():
             404,
         )
 
-    ## update the title
-    title = request_json.get("title", None)
-    if not title:
-        return jsonify({"error": "title is required"}), 400
-    conversation["title"] = title
-    updated_conversation = await cosmos_conversation_client.upsert_conversation(
-        conversation
-    )
-
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
 @bp.route("/history/delete_all", methods=["DELETE"])
+@history_container_route
 async def delete_all_conversations():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -1297,24 +1759,27 @@ async def delete_all_conversations():
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
+        conversation_count = await cosmos_conversation_client.count_conversations(user_id)
+        if not conversation_count:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
+        ## large histories are deleted in the background so the request does not time out
+        if conversation_count > int(HISTORY_DELETE_ALL_SYNC_LIMIT):
+            await invalidate_conversation_list(cosmos_conversation_client, user_id)
+            current_app.add_background_task(
+                delete_all_in_background, cosmos_conversation_client, user_id
             )
-
-            ## Now delete the conversation
-            deleted_conversation = await cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
+            return (
+                jsonify(
+                    {
+                        "message": f"Deleting {conversation_count} conversations and their messages for user {user_id}"
+                    }
+                ),
+                202,
             )
-        await cosmos_conversation_client.cosmosdb_client.close()
+
+        await cosmos_conversation_client.delete_all_conversations(user_id)
+        await invalidate_conversation_list(cosmos_conversation_client, user_id)
         return (
             jsonify(
                 {
@@ -1329,7 +1794,17 @@ async def delete_all_conversations():
         return jsonify({"error": str(e)}), 500
 
 
+async def delete_all_in_background(cosmos_conversation_client, user_id):
+    try:
+        deleted = await cosmos_conversation_client.delete_all_conversations(user_id)
+        logging.debug(f"Deleted {deleted} history documents for user {user_id}")
+    except Exception:
+        logging.exception("Exception while deleting all conversations in the background")
+    await invalidate_conversation_list(cosmos_conversation_client, user_id)
+
+
 @bp.route("/history/clear", methods=["POST"])
+@history_container_route
 async def clear_messages():
     ## get the user id from the request headers
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -1353,6 +1828,7 @@ async def clear_messages():
         deleted_messages = await cosmos_conversation_client.delete_messages(
             conversation_id, user_id
         )
+        await invalidate_conversation_list(cosmos_conversation_client, user_id)
 
         return (
             jsonify(
@@ -1369,6 +1845,7 @@ async def clear_messages():
 
 
 @bp.route("/history/ensure", methods=["GET"])
+@history_container_route
 async def ensure_cosmos():
     if not AZURE_COSMOSDB_ACCOUNT:
         return jsonify({"error": "CosmosDB is not configured"}), 404
@@ -1376,13 +1853,15 @@ async def ensure_cosmos():
     try:
         container_name = request.args.get("containerName", None)
         cosmos_conversation_client = init_cosmosdb_client(container_name)
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 500
+
         success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -1410,20 +1889,69 @@ async def ensure_cosmos():
         else:
             return jsonify({"error": "CosmosDB is not working"}), 500
 
+@bp.route("/history/metrics", methods=["GET"])
+async def history_metrics():
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    if not authenticated_user["user_principal_id"]:
+        return jsonify({"error": "Unauthorized"}), 401
+    ## with access control, the queue internals of the worker are only shown to admins
+    if ENABLE_ACCESS_CONTROL and not await is_admin_user(authenticated_user["user_name"]):
+        return jsonify({"error": "Forbidden"}), 403
+
+    cosmos_registry = current_app.cosmos_registry
+    write_queue = cosmos_registry.write_queue if cosmos_registry else None
+    return (
+        jsonify(
+            {
+                "write_behind_enabled": write_queue is not None,
+                "write_queue_depth": write_queue.depth if write_queue else 0,
+                "write_queue_dropped": write_queue.dropped if write_queue else 0,
+                "write_queue_dropped_not_found": write_queue.dropped_not_found if write_queue else 0,
+            }
+        ),
+        200,
+    )
+
+
+async def is_admin_user(user_name):
+    ## the role of the user in the tech hub (access control) container, from the index when it is loaded
+    access_control_index = current_app.access_control_index
+    if access_control_index and access_control_index.access_control_container:
+        return access_control_index.is_admin(user_name)
+
+    cosmos_access_control_client = init_cosmosdb_access_control(AZURE_COSMOSDB_TECH_HUB_CONTAINER, AZURE_COSMOSDB_ACCESS_CONTROL_DATABASE)
+    if not cosmos_access_control_client:
+        return False
+    userList = await cosmos_access_control_client.get_access_control_query(user_name)
+    return any(item.get("role") == "Admin" for item in userList)
+
 @bp.route("/useCase/name_list", methods=["GET"])
 async def list_usecases():
     container_name = AZURE_USECASE_COSMOSDB_QUERY_CONTAINER
-    userId = request.args.get("user", None)
+    ## the role and groups are those of the signed in user, never of a name the client sends
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    userId = authenticated_user["user_name"]
 
     ## make sure cosmos is configured
     cosmos_conversation_client = init_cosmosdb_client(container_name)
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    useCaseIds = 0
+    useCaseIds = ()
     isAdmin = 1
+    ## the use case list is not filtered by access control yet, whatever the app-wide setting
     ENABLE_ACCESS_CONTROL = False
-    if ENABLE_ACCESS_CONTROL:  
+    if ENABLE_ACCESS_CONTROL and not userId:
+        return jsonify({"error": "Unauthorized"}), 401
+    access_control_index = current_app.access_control_index
+    if ENABLE_ACCESS_CONTROL and access_control_index and access_control_index.access_control_container:
+        ## dictionary lookups in the per-worker index instead of container queries
+        isAdmin = 1 if access_control_index.is_admin(userId) else 0
+        if isAdmin == 0:
+            userGroup = await fetch_groups_for_user(userId)
+            groupNameArr = [list.get("displayName") for list in userGroup if list.get("displayName") != None]
+            useCaseIds = tuple(sorted(access_control_index.get_usecase_ids(groupNameArr)))
+    elif ENABLE_ACCESS_CONTROL:  
         ## make sure cosmos is configured for access control
         cosmos_access_control_client = init_cosmosdb_access_control(AZURE_COSMOSDB_TECH_HUB_CONTAINER, AZURE_COSMOSDB_ACCESS_CONTROL_DATABASE)
         if not cosmos_access_control_client:
@@ -1436,23 +1964,79 @@ async def list_usecases():
         if isAdmin == 0:
             userGroup = await fetch_groups_for_user(userId)
             if len(userGroup):
-                groupNameArr = [list["displayName"] for list in userGroup if list["displayName"] != None]
-                groupNames = ", ".join(f"'{name}'" for name in groupNameArr) if len(groupNameArr) else 0
+                groupNameArr = [list.get("displayName") for list in userGroup if list.get("displayName") != None]
                 if len(groupNameArr):
-                    AD_Data = await cosmos_access_control_client.get_access_control_by_group_name(groupNames, len(groupNameArr)) 
-                    useCaseIdArr = [list["use_case_id"] for list in AD_Data]
-                    useCaseIds = ", ".join(f"{int(id)}" for id in useCaseIdArr) if len(useCaseIdArr) else 0
-        await cosmos_access_control_client.cosmosdb_client.close()
-
-    ## get the conversations from cosmos
-    useCases = await cosmos_conversation_client.get_usecases(userId, isAdmin, useCaseIds)
-    await cosmos_conversation_client.cosmosdb_client.close()
+                    AD_Data = await cosmos_access_control_client.get_access_control_by_group_name(groupNameArr, len(groupNameArr)) 
+                    useCaseIds = tuple(sorted({int(list["use_case_id"]) for list in AD_Data}))
+
+    useCases, etag = await get_usecase_names(cosmos_conversation_client, userId, isAdmin, useCaseIds)
     if not isinstance(useCases, list):
         return jsonify({"error": f"No conversations for {userId} were found"}), 404
 
-    ## return the conversation ids
+    ## return the use case names, or 304 when the client already has them
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(useCases)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"private, max-age={int(USECASE_LIST_MAX_AGE)}, must-revalidate"
+    return response
+
+async def get_usecase_names(cosmos_conversation_client, userId, isAdmin, useCaseIds):
+    ## the use case names and their ETag, from the cache, or from the access control index (cosmos when there is none)
+    ## the list only depends on the role and the use cases of the user's groups
+    access_control_index = current_app.access_control_index
+
+    async def load_usecases():
+        if access_control_index:
+            useCases = access_control_index.get_usecase_names(None if isAdmin else useCaseIds)
+        else:
+            useCases = await cosmos_conversation_client.get_usecases(userId, isAdmin, useCaseIds)
+        if not isinstance(useCases, list):
+            return None, None
+        etag = hashlib.sha256(json.dumps(useCases).encode("utf-8")).hexdigest()
+        return useCases, etag
+
+    cache_key = (get_usecase_list_version(), isAdmin, useCaseIds)
+    return await usecase_list_cache.get_or_load(cache_key, load_usecases)
+
+
+def generate_local_title(conversation_messages):
+    ## the first words of the question, used until the generated title is ready
+    words = conversation_messages[-1]["content"].split()
+    title = " ".join(words[:TITLE_LOCAL_WORD_COUNT])
+    return title + "..." if len(words) > TITLE_LOCAL_WORD_COUNT else title
+
+
+async def update_generated_title(
+    cosmos_conversation_client,
+    user_id,
+    conversation_id,
+    local_title,
+    conversation_messages,
+    history_metadata,
+):
+    ## runs as a background task and yields to the chat requests of this worker
+    ## the title may be written after the response was sent; the next list fetch then reads it from cosmos
+    try:
+        async with title_generation_semaphore:
+            title = await generate_title(conversation_messages)
+        if not title or title == local_title:
+            return
+
+        updated_conversation = await cosmos_conversation_client.update_conversation_title(
+            user_id, conversation_id, title, current_title=local_title
+        )
+        await invalidate_conversation_list(cosmos_conversation_client, user_id)
+    except Exception:
+        logging.exception(f"Exception while updating the generated title of conversation {conversation_id}")
+        return
+
+    # frames streamed from now on carry the new title to the client
+    if updated_conversation:
+        history_metadata["title"] = title
 
-    return jsonify(useCases), 200
 
 async def generate_title(conversation_messages):
     ## make sure the messages are sorted by _ts descending
@@ -1465,7 +2049,7 @@ async def generate_title(conversation_messages):
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client(use_data=False)
+        azure_openai_client = get_azure_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=AZURE_OPENAI_MODEL, messages=messages, temperature=1, max_tokens=64
         )
@@ -1473,7 +2057,8 @@ async def generate_title(conversation_messages):
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception as e:
-        return messages[-2]["content"]
+        logging.exception("Exception in generate_title")
+        return None
 
 # Function to generate a SAS token for a blob
 def generate_sas_for_blob(blob_name):
@@ -1505,37 +2090,45 @@ async def get_pdf_sas_url():
     else:
         return jsonify({"error": "Invalid blob name or not a PDF file"}), 400
 
-msal_app = msal.ConfidentialClientApplication(
-    AZURE_CLIENT_ID,
-    authority=AUTHORITY,
-    client_credential=AZURE_CLIENT_SECRET,)    
-
 async def fetch_groups_for_user(userId):
     user_principal_name = userId  # Use userPrincipalName
  
     if not user_principal_name:
-        return {"error": "userPrincipalName not provided in the message"}
- 
-    loop = asyncio.get_event_loop()
-    with ThreadPoolExecutor() as executor:
-        token_response = await loop.run_in_executor(executor, msal_app.acquire_token_for_client, SCOPES)
- 
-    if "access_token" in token_response:
-        access_token = token_response["access_token"]
-        headers = {"Authorization": f"Bearer {access_token}"}
- 
-        async with httpx.AsyncClient() as client:
-            user_response = await client.get(f"https://graph.microsoft.com/v1.0/users/{user_principal_name}/memberOf",
-                headers=headers
-            )
-            if user_response.status_code == 200:
-                groups = user_response.json().get("value", [])
-                group_details = [{"displayName": group.get("displayName"), "id": group.get("id")} for group in groups]
-                return group_details
-            else:
-                return []
-    else:
+        logging.error("userPrincipalName not provided, no groups to fetch")
+        return []
+
+    # Concurrent lookups for the same user share one Graph call
+    # A failed lookup returns no groups for this request only, it is not cached
+    try:
+        group_details = await graph_group_cache.get_or_load(
+            ("users", user_principal_name.lower()),
+            lambda: fetch_groups_from_graph(user_principal_name),
+        )
+    except Exception:
+        logging.exception("Exception while fetching groups for user")
         return []
+    return group_details or []
+
+
+async def fetch_groups_from_graph(user_principal_name):
+    ## raises when the groups can't be read, so only an actual empty membership is cached
+    token = await current_app.credential_manager.get_token(SCOPES[0])
+    if not token:
+        raise Exception("Unable to acquire Microsoft Graph token")
+
+    access_token = token.token
+    headers = {"Authorization": f"Bearer {access_token}"}
+ 
+    client = current_app.http_clients.get_client(MS_GRAPH_ENDPOINT)
+    user_response = await client.get(f"{MS_GRAPH_ENDPOINT}/users/{user_principal_name}/memberOf",
+        headers=headers
+    )
+    if user_response.status_code != 200:
+        raise Exception(f"Error fetching groups for user: {user_response.status_code} {user_response.text}")
+
+    groups = user_response.json().get("value", [])
+    group_details = [{"displayName": group.get("displayName"), "id": group.get("id")} for group in groups]
+    return group_details
 
 
 app = create_app()
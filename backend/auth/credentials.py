@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from azure.core.credentials import AccessToken
+from azure.core.exceptions import ClientAuthenticationError
+
+# Refresh tokens this many seconds before they expire
+DEFAULT_REFRESH_MARGIN = 300
+# Wait at least this long between two background refresh attempts
+MIN_REFRESH_INTERVAL = 30
+
+
+class CredentialManager():
+
+    def __init__(self, default_credential=None, refresh_margin: int = DEFAULT_REFRESH_MARGIN):
+        self.default_credential = default_credential
+        self.refresh_margin = refresh_margin
+        self._credentials = {}
+        self._tokens = {}
+        self._refresh_on = {}
+        self._locks = {}
+        self._refresh_tasks = {}
+
+    def register(self, scope: str, credential):
+        ## scopes that are not registered are served by the default credential
+        self._credentials[scope] = credential
+
+    def get_bearer_token_provider(self, scope: str):
+        async def wrapper():
+            token = await self.get_token(scope)
+            return token.token
+
+        return wrapper
+
+    def get_credential(self):
+        return ManagedTokenCredential(self)
+
+    async def get_token(self, scope: str) -> AccessToken:
+        token = self._tokens.get(scope)
+        if not token or time.time() >= self._refresh_on[scope]:
+            token = await self._refresh(scope)
+
+        self.start(scope)
+        return token
+
+    def start(self, scope: str):
+        ## keep the token of this scope refreshed by a single background task
+        if scope not in self._refresh_tasks:
+            self._refresh_tasks[scope] = asyncio.create_task(self._refresh_loop(scope))
+
+    async def _refresh(self, scope: str, force: bool = False) -> AccessToken:
+        lock = self._locks.setdefault(scope, asyncio.Lock())
+        async with lock:
+            ## concurrent callers wait for the refresh that is already running
+            token = self._tokens.get(scope)
+            if token and not force and time.time() < self._refresh_on[scope]:
+                return token
+
+            credential = self._credentials.get(scope, self.default_credential)
+            if not credential:
+                raise ClientAuthenticationError(message=f"No credential configured for scope {scope}")
+
+            token = await credential.get_token(scope)
+            now = time.time()
+            self._tokens[scope] = token
+            ## short-lived tokens are refreshed half way through their lifetime
+            self._refresh_on[scope] = token.expires_on - min(
+                self.refresh_margin, (token.expires_on - now) / 2
+            )
+            return token
+
+    async def _refresh_loop(self, scope: str):
+        ## fetch right away when started before the first token was requested
+        delay = self._refresh_on[scope] - time.time() if scope in self._refresh_on else 0
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._refresh(scope, force=True)
+                delay = max(self._refresh_on[scope] - time.time(), MIN_REFRESH_INTERVAL)
+            except Exception:
+                logging.exception(f"Background token refresh failed for scope {scope}")
+                delay = MIN_REFRESH_INTERVAL
+
+    async def close(self):
+        for task in self._refresh_tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._refresh_tasks.values(), return_exceptions=True)
+        self._refresh_tasks = {}
+
+        credentials = list(self._credentials.values()) + [self.default_credential]
+        closed = set()
+        for credential in credentials:
+            if credential is None or id(credential) in closed:
+                continue
+            closed.add(id(credential))
+            if hasattr(credential, "close"):
+                await credential.close()
+
+
+class ManagedTokenCredential():
+    ## AsyncTokenCredential backed by the CredentialManager cache, e.g. for CosmosClient
+    ## The manager owns the underlying credentials, so closing this is a no-op
+
+    def __init__(self, credential_manager: CredentialManager):
+        self.credential_manager = credential_manager
+
+    async def get_token(self, *scopes: str, **kwargs) -> AccessToken:
+        return await self.credential_manager.get_token(scopes[0])
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
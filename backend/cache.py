@@ -0,0 +1,67 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache():
+    ## Bounded LRU cache whose entries expire after a TTL
+    ## Empty results are kept for the shorter negative_ttl
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, negative_ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl if value else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        ## single flight: concurrent misses for the same key share one loader call
+        task = self._inflight.get(key)
+        if not task:
+            task = asyncio.create_task(self._load(key, loader))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+            self.set(key, value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+
+# Projections of the full loads, shaped like the documents the change feed returns
+ACCESS_CONTROL_QUERY = "SELECT c._rid, c.user, c.role, c.use_case_id, c.ad_groups FROM c"
+USECASE_QUERY = (
+    "SELECT c._rid, c.use_case_id, {'formData': {'useCaseName': c.Frontend.formData.useCaseName, "
+    "'uiRequired': c.Frontend.formData.uiRequired, 'createdAt': c.Frontend.formData.createdAt}} AS Frontend FROM c"
+)
+
+
+class AccessControlIndex():
+    ## Per-worker index of the tech hub (access control) and use case containers
+    ## Resolves roles, the use cases of a group set and use case names with dictionary lookups
+    ## Loaded in full at startup and every reload_interval (the change feed has no deletions), kept current in between
+    ## by apply_access_control_changes / apply_usecase_changes as change feed listeners
+
+    def __init__(self, access_control_container=None, usecase_container=None, reload_interval: float = 3600):
+        self.access_control_container = access_control_container
+        self.usecase_container = usecase_container
+        self.reload_interval = reload_interval
+        self.access_documents = {}
+        self.user_roles = {}
+        self.group_documents = {}
+        self.usecases = {}
+        self._task = None
+
+    async def load(self):
+        access_documents = []
+        if self.access_control_container:
+            access_documents = [item async for item in self.access_control_container.query_items(query=ACCESS_CONTROL_QUERY)]
+        usecase_documents = []
+        if self.usecase_container:
+            usecase_documents = [item async for item in self.usecase_container.query_items(query=USECASE_QUERY)]
+
+        ## swap in the new index only once both containers were read
+        self.access_documents, self.user_roles, self.group_documents, self.usecases = {}, {}, {}, {}
+        self.apply_access_control_changes(access_documents)
+        self.apply_usecase_changes(usecase_documents)
+        logging.debug(f"Access control index loaded {len(self.access_documents)} access control and {len(self.usecases)} use case documents")
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._reload_loop())
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await self.load()
+            except Exception:
+                logging.exception("Exception while reloading the access control index")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def apply_access_control_changes(self, documents):
+        for document in documents:
+            rid = document.get('_rid') or document.get('id')
+            self._remove_access_document(rid)
+
+            groups = {group['name'] for group in document.get('ad_groups') or [] if isinstance(group, dict) and 'name' in group}
+            entry = {
+                'user': document.get('user'),
+                'role': document.get('role'),
+                'use_case_id': document.get('use_case_id'),
+                'groups': groups,
+            }
+            self.access_documents[rid] = entry
+            if entry['user'] is not None:
+                self.user_roles.setdefault(entry['user'], {})[rid] = entry['role']
+            for group in groups:
+                self.group_documents.setdefault(group, set()).add(rid)
+
+    def _remove_access_document(self, rid):
+        entry = self.access_documents.pop(rid, None)
+        if not entry:
+            return
+        roles = self.user_roles.get(entry['user'])
+        if roles is not None:
+            roles.pop(rid, None)
+            if not roles:
+                del self.user_roles[entry['user']]
+        for group in entry['groups']:
+            rids = self.group_documents.get(group)
+            if rids is not None:
+                rids.discard(rid)
+                if not rids:
+                    del self.group_documents[group]
+
+    def apply_usecase_changes(self, documents):
+        for document in documents:
+            rid = document.get('_rid') or document.get('id')
+            form_data = (document.get('Frontend') or {}).get('formData') or {}
+            ## documents without a name never showed up in the name list
+            if 'useCaseName' not in form_data:
+                self.usecases.pop(rid, None)
+                continue
+            self.usecases[rid] = {
+                'use_case_id': document.get('use_case_id'),
+                'name': form_data['useCaseName'],
+                'ui_required': form_data.get('uiRequired') is True,
+                'created_at': form_data.get('createdAt'),
+            }
+
+    def is_admin(self, user) -> bool:
+        return 'Admin' in self.user_roles.get(user, {}).values()
+
+    def get_usecase_ids(self, group_names) -> set:
+        ## use cases of the access control documents that list every one of the user's groups
+        groups = set(group_names)
+        if not groups:
+            return set()
+
+        rids = None
+        for group in groups:
+            group_rids = self.group_documents.get(group, set())
+            rids = set(group_rids) if rids is None else rids & group_rids
+            if not rids:
+                return set()
+        return {
+            int(self.access_documents[rid]['use_case_id'])
+            for rid in rids
+            if self.access_documents[rid]['use_case_id'] is not None
+        }
+
+    def get_all_usecase_names(self) -> set:
+        ## every use case name, including those not shown in the UI
+        return {usecase['name'] for usecase in self.usecases.values()}
+
+    def get_usecase_names(self, use_case_ids=None) -> list:
+        ## names of the use cases shown in the UI, newest first; use_case_ids None means all of them
+        usecases = [
+            usecase for usecase in self.usecases.values()
+            if usecase['ui_required'] and (use_case_ids is None or usecase['use_case_id'] in use_case_ids)
+        ]
+        usecases.sort(
+            key=lambda usecase: (usecase['created_at'] is not None, str(usecase['created_at'] or '')),
+            reverse=True,
+        )
+        return [usecase['name'] for usecase in usecases]
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+# Each poll re-reads this much of the previous window, so changes are not missed because of clock skew
+CHANGE_FEED_OVERLAP = timedelta(seconds=5)
+
+
+class ChangeFeedWatcher():
+    ## Polls the change feed of one container and passes the changed documents to its listeners
+    ## Listeners may be called twice for the same change; deletions are not part of the change feed
+
+    def __init__(self, container_client, interval: float = 30):
+        self.container_client = container_client
+        self.interval = interval
+        self.version = 0
+        self.listeners = []
+        self._since = datetime.now(timezone.utc)
+        self._task = None
+
+    def add_listener(self, listener):
+        ## listener(changed_documents) can be a plain function or a coroutine function
+        self.listeners.append(listener)
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def poll(self):
+        polled_at = datetime.now(timezone.utc)
+        feed = self.container_client.query_items_change_feed(start_time=self._since - CHANGE_FEED_OVERLAP)
+        changed = [item async for item in feed]
+        self._since = polled_at
+        if not changed:
+            return changed
+
+        self.version += 1
+        for listener in self.listeners:
+            try:
+                result = listener(changed)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logging.exception("Exception in change feed listener")
+        return changed
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except Exception:
+                logging.exception("Exception while polling the change feed")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -1,23 +1,116 @@
+import asyncio
+import base64
+import binascii
+import json
+import logging
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
-from azure.cosmos import exceptions
+from azure.cosmos import PartitionKey, exceptions
+from backend.history.writebehind import HistoryWriteQueue, MAX_BATCH_OPERATIONS
   
+def create_cosmos_client(cosmosdb_endpoint: str, credential: any):
+    try:
+        return CosmosClient(cosmosdb_endpoint, credential=credential)
+    except exceptions.CosmosHttpResponseError as e:
+        if e.status_code == 401:
+            raise ValueError("Invalid credentials") from e
+        else:
+            raise ValueError("Invalid CosmosDB endpoint") from e
+
+
+# Fields returned by the projection variants of the list and read queries
+CONVERSATION_LIST_FIELDS = ('id', 'type', 'user_id', 'title', 'createdAt', 'updatedAt')
+MESSAGE_READ_FIELDS = ('id', 'role', 'content', 'createdAt', 'feedback')
+
+
+# Indexing policy of the history containers: only the queried and sorted paths are indexed,
+# so message content and tool/citation payloads add nothing to the write RU charge
+HISTORY_INDEXING_POLICY = {
+    'indexingMode': 'consistent',
+    'automatic': True,
+    'includedPaths': [
+        {'path': '/user_id/?'},
+        {'path': '/type/?'},
+        {'path': '/conversationId/?'},
+        {'path': '/createdAt/?'},
+        {'path': '/updatedAt/?'},
+    ],
+    'excludedPaths': [
+        {'path': '/*'},
+        {'path': '/"_etag"/?'},
+    ],
+    'compositeIndexes': [
+        [
+            {'path': '/user_id', 'order': 'ascending'},
+            {'path': '/type', 'order': 'ascending'},
+            {'path': '/updatedAt', 'order': 'descending'},
+        ],
+        [
+            {'path': '/conversationId', 'order': 'ascending'},
+            {'path': '/type', 'order': 'ascending'},
+            {'path': '/createdAt', 'order': 'ascending'},
+        ],
+    ],
+}
+
+
+def indexing_policy_differences(policy: dict, expected: dict = HISTORY_INDEXING_POLICY) -> list:
+    ## what the container's indexing policy is missing compared to the expected one
+    def composite_key(composite):
+        return tuple((index['path'], index.get('order', 'ascending')) for index in composite)
+
+    differences = []
+    composites = {composite_key(composite) for composite in policy.get('compositeIndexes', [])}
+    for composite in expected['compositeIndexes']:
+        if composite_key(composite) not in composites:
+            differences.append(f"missing composite index {[index['path'] for index in composite]}")
+
+    excluded = {path['path'] for path in policy.get('excludedPaths', [])}
+    for path in expected['excludedPaths']:
+        if path['path'] not in excluded:
+            differences.append(f"path {path['path']} is not excluded")
+
+    included = {path['path'] for path in policy.get('includedPaths', [])}
+    for path in expected['includedPaths']:
+        if path['path'] not in included:
+            differences.append(f"path {path['path']} is not included")
+    return differences
+
+
+def select_clause(fields: tuple = None) -> str:
+    if not fields:
+        return '*'
+    return ', '.join(f'c.{field}' for field in fields)
+
+
+def encode_cursor(continuation_token: str) -> str:
+    ## the continuation token is opaque to clients, and url safe
+    return base64.urlsafe_b64encode(continuation_token.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, cosmosdb_client: CosmosClient = None, write_queue: HistoryWriteQueue = None, delete_concurrency: int = 5):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
-        try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
-        except exceptions.CosmosHttpResponseError as e:
-            if e.status_code == 401:
-                raise ValueError("Invalid credentials") from e
-            else:
-                raise ValueError("Invalid CosmosDB endpoint") from e
+        ## number of delete batches in flight at once
+        self.delete_concurrency = delete_concurrency
+        ## with a write queue, message, conversation and feedback writes are committed in the background
+        self.write_queue = write_queue
+        ## a shared CosmosClient is owned (and closed) by whoever passed it in
+        self.cosmosdb_client = cosmosdb_client or create_cosmos_client(self.cosmosdb_endpoint, credential)
 
         try:
             self.database_client = self.cosmosdb_client.get_database_client(database_name)
@@ -45,12 +138,40 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
-    async def create_conversation(self, user_id, title = ''):
+    async def check_indexing_policy(self, apply: bool = False):
+        ## compare the container's indexing policy with HISTORY_INDEXING_POLICY, and replace it when apply is set
+        properties = await self.container_client.read()
+        differences = indexing_policy_differences(properties.get('indexingPolicy', {}))
+        if not differences:
+            return True
+
+        if not apply:
+            logging.warning(f"Indexing policy of CosmosDB container {self.container_name} is not up to date: {'; '.join(differences)}")
+            return False
+
+        logging.warning(f"Replacing indexing policy of CosmosDB container {self.container_name}: {'; '.join(differences)}")
+        ## the partition key cannot change, so the existing definition is passed back as is
+        partition_key = properties['partitionKey']
+        paths = partition_key['paths']
+        await self.database_client.replace_container(
+            self.container_client,
+            partition_key=PartitionKey(
+                path=paths[0] if len(paths) == 1 else paths,
+                kind=partition_key.get('kind', 'Hash'),
+                version=partition_key.get('version', 2),
+            ),
+            indexing_policy=HISTORY_INDEXING_POLICY,
+            default_ttl=properties.get('defaultTtl'),
+        )
+        return True
+
+    async def create_conversation(self, user_id, title = '', conversation_id = None, created_at = None):
+        created_at = created_at or datetime.utcnow().isoformat()
         conversation = {
-            'id': str(uuid.uuid4()),  
+            'id': conversation_id or str(uuid.uuid4()),  
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': created_at,  
+            'updatedAt': created_at,  
             'user_id': user_id,
             'title': title
         }
@@ -63,40 +184,141 @@ class CosmosConversationClient():
             return False
     
     async def upsert_conversation(self, conversation):
+        if self.write_queue:
+            self.write_queue.enqueue(self.container_client, conversation['user_id'], [('upsert', (conversation,))])
+            return conversation
+
         resp = await self.container_client.upsert_item(conversation)
         if resp:
             return resp
         else:
             return False
 
+    async def update_conversation_title(self, user_id, conversation_id, title, current_title=None):
+        ## with current_title set, a title that changed in the meantime (e.g. a rename) is kept
+        filter_predicate = "FROM c WHERE c.type = 'conversation'"
+        if current_title is not None:
+            filter_predicate += f" AND c.title = {json.dumps(current_title)}"
+        try:
+            return await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/title', 'value': title}],
+                filter_predicate=filter_predicate,
+            )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
+            return False
+
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
-            return resp
-        else:
+        try:
+            return await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return True
         
     async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
-
-    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        ## delete all the messages in the conversation, returns how many were deleted
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@user_id',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.user_id = @user_id"
+        return await self.delete_items(user_id, query, parameters)
+
+    async def delete_all_conversations(self, user_id):
+        ## delete every conversation and message of the user, returns how many documents were deleted
+        parameters = [
+            {
+                'name': '@user_id',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id FROM c WHERE c.user_id = @user_id AND (c.type='message' OR c.type='conversation')"
+        return await self.delete_items(user_id, query, parameters)
+
+    async def count_conversations(self, user_id):
+        parameters = [
+            {
+                'name': '@user_id',
+                'value': user_id
+            }
+        ]
+        query = "SELECT VALUE COUNT(1) FROM c WHERE c.user_id = @user_id AND c.type='conversation'"
+        async for count in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            return count
+        return 0
+
+    async def delete_items(self, user_id, query, parameters):
+        ## stream the ids from the query and delete them in transactional batches of the user's partition,
+        ## with at most delete_concurrency batches in flight so the query is not read further ahead than that
+        semaphore = asyncio.Semaphore(self.delete_concurrency)
+        tasks = []
+        ids = []
+        try:
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+                ids.append(item['id'])
+                if len(ids) == MAX_BATCH_OPERATIONS:
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(self.delete_batch(user_id, ids, semaphore)))
+                    ids = []
+            if ids:
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(self.delete_batch(user_id, ids, semaphore)))
+
+            deleted = await asyncio.gather(*tasks)
+        except BaseException:
+            ## a failed query or batch cancels the batches still in flight, and their results are retrieved
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return sum(deleted)
+
+    async def delete_batch(self, user_id, ids, semaphore):
+        try:
+            try:
+                await self.container_client.execute_item_batch(
+                    batch_operations=[('delete', (item_id,)) for item_id in ids],
+                    partition_key=user_id,
+                )
+            except exceptions.CosmosBatchOperationError:
+                ## an item deleted in the meantime rolls the whole batch back, so delete them one by one
+                await asyncio.gather(*[self.delete_item(user_id, item_id) for item_id in ids])
+            return len(ids)
+        finally:
+            semaphore.release()
+
+    async def delete_item(self, user_id, item_id):
+        try:
+            await self.container_client.delete_item(item=item_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0, fields = None):
         parameters = [
             {
                 'name': '@user_id',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.user_id = @user_id and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = f"SELECT {select_clause(fields)} FROM c where c.user_id = @user_id and c.type='conversation' order by c.updatedAt {sort_order}"
         if limit is not None:
-            query += f" offset {offset} limit {limit}" 
+            query += " offset @offset limit @limit"
+            parameters += [
+                {
+                    'name': '@offset',
+                    'value': int(offset)
+                },
+                {
+                    'name': '@limit',
+                    'value': int(limit)
+                }
+            ]
         
         conversations = []
         async for item in self.container_client.query_items(query=query, parameters=parameters):
@@ -104,29 +326,54 @@ class CosmosConversationClient():
         
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
+    async def get_conversations_page(self, user_id, limit, sort_order = 'DESC', cursor = None, fields = None):
+        ## one page of conversations, and the cursor of the next page (None on the last page)
+        ## unlike OFFSET, continuing from a cursor does not re-read the skipped conversations
+        ## cosmos can return short or empty pages before the end, so pages are read until limit conversations
+        ## were collected; as clients take a short page for the end of the list, only the last page is short
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@user_id',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.user_id = @user_id"
+        query = f"SELECT {select_clause(fields)} FROM c where c.user_id = @user_id and c.type='conversation' order by c.updatedAt {sort_order}"
+        continuation_token = decode_cursor(cursor) if cursor else None
+
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        try:
+            while True:
+                ## each query asks for the remaining count, so a page never ends past limit
+                pages = self.container_client.query_items(
+                    query=query, parameters=parameters, partition_key=user_id, max_item_count=limit - len(conversations)
+                ).by_page(continuation_token)
+                next_token = None
+                async for page in pages:
+                    conversations.extend([item async for item in page])
+                    next_token = pages.continuation_token
+                    break
+                if not next_token or len(conversations) >= limit:
+                    return conversations, encode_cursor(next_token) if next_token else None
+                continuation_token = next_token
+        except exceptions.CosmosHttpResponseError as e:
+            ## a cursor that decodes but is not a continuation token of this query
+            if e.status_code == 400 and cursor:
+                raise ValueError("Invalid cursor") from e
+            raise
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    async def get_conversation(self, user_id, conversation_id):
+        ## point read by id and partition key
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversations[0]
+
+        ## if no conversation is found, return None
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    def build_message(self, uuid, conversation_id, user_id, input_message: dict):
         message = {
             'id': uuid,
             'type': 'message',
@@ -140,29 +387,100 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
+        return message
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        message = self.build_message(uuid, conversation_id, user_id, input_message)
+
+        if self.write_queue:
+            ## the parent's updatedAt is bumped in the same transactional batch
+            self.write_queue.enqueue(self.container_client, user_id, [
+                ('upsert', (message,)),
+                ('patch', (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': message['createdAt']}])),
+            ])
+            return message
         
         resp = await self.container_client.upsert_item(message)  
         if resp:
             ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+            if not await self.update_conversation_updated_at(user_id, conversation_id, message['createdAt']):
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
+
+    async def create_messages(self, conversation_id, user_id, input_messages: list):
+        ## write several (uuid, message) pairs of one conversation and bump its updatedAt
+        ## as a single transactional batch, so either all of them are stored or none
+        messages = [
+            self.build_message(uuid, conversation_id, user_id, input_message)
+            for uuid, input_message in input_messages
+        ]
+        updated_at = messages[-1]['createdAt']
+        patch_operations = [{'op': 'set', 'path': '/updatedAt', 'value': updated_at}]
+        batch_operations = [('upsert', (message,)) for message in messages]
+
+        if self.write_queue:
+            self.write_queue.enqueue(self.container_client, user_id, batch_operations + [
+                ('patch', (conversation_id, patch_operations)),
+            ])
+            return messages
+
+        try:
+            await self.container_client.execute_item_batch(
+                batch_operations=batch_operations + [
+                    ('patch', (conversation_id, patch_operations), {
+                        'filter_predicate': f"FROM c WHERE c.type = 'conversation' AND c.updatedAt < {json.dumps(updated_at)}",
+                    }),
+                ],
+                partition_key=user_id,
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index != len(batch_operations):
+                raise
+            if e.operation_responses[e.error_index].get('statusCode') != 412:
+                return "Conversation not found"
+            ## a newer message already bumped updatedAt, so store the messages alone
+            if not await self.get_conversation(user_id, conversation_id):
+                return "Conversation not found"
+            await self.container_client.execute_item_batch(batch_operations=batch_operations, partition_key=user_id)
+        return messages
+
+    async def update_conversation_updated_at(self, user_id, conversation_id, updated_at):
+        ## patch only the timestamp, and never move it backwards when writes land out of order
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': updated_at}],
+                filter_predicate=f"FROM c WHERE c.type = 'conversation' AND c.updatedAt < {json.dumps(updated_at)}",
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        except exceptions.CosmosAccessConditionFailedError:
+            ## either a newer message already bumped it, or the id is not a conversation
+            conversation = await self.get_conversation(user_id, conversation_id)
+            return conversation is not None
+        return True
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
-        else:
+        if self.write_queue:
+            self.write_queue.enqueue(self.container_client, user_id, [
+                ('patch', (message_id, [{'op': 'set', 'path': '/feedback', 'value': feedback}])),
+            ])
+            return {'id': message_id, 'feedback': feedback}
+
+        try:
+            return await self.container_client.patch_item(
+                item=message_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback}],
+                filter_predicate="FROM c WHERE c.type = 'message'",
+            )
+        except (exceptions.CosmosResourceNotFoundError, exceptions.CosmosAccessConditionFailedError):
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+    async def get_messages(self, user_id, conversation_id, fields = None):
         parameters = [
             {
                 'name': '@conversationId',
@@ -173,24 +491,26 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.user_id = @user_id ORDER BY c.timestamp ASC"
+        query = f"SELECT {select_clause(fields)} FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.user_id = @user_id ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
             messages.append(item)
 
         return messages
 
     async def get_usecases(self, user, isAdmin, useCaseIds):
-        parameters = [
-            {
-                'name': '@userId',
-                'value': user
-            }
-        ]
+        ## useCaseIds is passed as an array parameter, so every user shares the same query text and plan
+        parameters = []
         if isAdmin:
-            query = f"SELECT VALUE c.Frontend.formData.useCaseName FROM c where c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
+            query = "SELECT VALUE c.Frontend.formData.useCaseName FROM c where c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
         else:
-            query = f"SELECT VALUE c.Frontend.formData.useCaseName FROM c where c.use_case_id in ({useCaseIds}) and c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
+            parameters = [
+                {
+                    'name': '@useCaseIds',
+                    'value': list(useCaseIds)
+                }
+            ]
+            query = "SELECT VALUE c.Frontend.formData.useCaseName FROM c where ARRAY_CONTAINS(@useCaseIds, c.use_case_id) and c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
         
         useCases = []
         async for item in self.container_client.query_items(query=query, parameters=parameters):
@@ -198,6 +518,15 @@ class CosmosConversationClient():
         
         return useCases
 
+    async def get_all_usecase_names(self):
+        ## every use case name, shown in the UI or not; the chat history containers are named after them
+        query = "SELECT VALUE c.Frontend.formData.useCaseName FROM c WHERE IS_DEFINED(c.Frontend.formData.useCaseName)"
+        useCaseNames = []
+        async for item in self.container_client.query_items(query=query):
+            useCaseNames.append(item)
+
+        return useCaseNames
+
     async def get_access_control_query(self, user):
         parameters = [
             {
@@ -216,13 +545,61 @@ class CosmosConversationClient():
         parameters = [
             {
                 'name': '@groupNames',
-                'value': groupNames
+                'value': list(groupNames)
+            },
+            {
+                'name': '@groupCount',
+                'value': groupCount
             }
         ]
-        query = f"SELECT * FROM c WHERE (SELECT VALUE COUNT(1) FROM g IN c.ad_groups WHERE g.name IN ({groupNames})) = {groupCount}"
+        query = "SELECT * FROM c WHERE (SELECT VALUE COUNT(1) FROM g IN c.ad_groups WHERE ARRAY_CONTAINS(@groupNames, g.name)) = @groupCount"
         result = [item async for item in self.container_client.query_items(query=query, parameters=parameters)]
         ## if no result are found, return false
         if len(result) == 0:
             return []
         else:
-            return result
\ No newline at end of file
+            return result
+
+
+class CosmosConversationClientRegistry():
+    ## One CosmosClient per worker, shared by a lazily created client per database and container
+    ## At most max_clients are kept, the least recently used one is dropped first
+
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, enable_message_feedback: bool = False, write_queue: HistoryWriteQueue = None, delete_concurrency: int = 5, max_clients: int = 256):
+        self.cosmosdb_endpoint = cosmosdb_endpoint
+        self.credential = credential
+        self.database_name = database_name
+        self.enable_message_feedback = enable_message_feedback
+        self.delete_concurrency = delete_concurrency
+        self.write_queue = write_queue
+        self.max_clients = max_clients
+        self.cosmosdb_client = create_cosmos_client(self.cosmosdb_endpoint, credential)
+        self.clients = OrderedDict()
+
+    def get_client(self, container_name: str, database_name: str = None) -> CosmosConversationClient:
+        database_name = database_name or self.database_name
+        key = (database_name, container_name)
+        client = self.clients.get(key)
+        if client:
+            self.clients.move_to_end(key)
+        else:
+            client = CosmosConversationClient(
+                cosmosdb_endpoint=self.cosmosdb_endpoint,
+                credential=self.credential,
+                database_name=database_name,
+                container_name=container_name,
+                enable_message_feedback=self.enable_message_feedback,
+                cosmosdb_client=self.cosmosdb_client,
+                write_queue=self.write_queue,
+                delete_concurrency=self.delete_concurrency,
+            )
+            self.clients[key] = client
+            while len(self.clients) > self.max_clients:
+                self.clients.popitem(last=False)
+        return client
+
+    async def close(self):
+        if self.write_queue:
+            await self.write_queue.close()
+        self.clients = OrderedDict()
+        await self.cosmosdb_client.close()
@@ -0,0 +1,140 @@
+import json
+import logging
+import time
+from backend.cache import TTLCache
+
+# Stores a page only while the user's generation is still the one it was loaded under
+REDIS_SET_PAGE_SCRIPT = """
+if (tonumber(redis.call('GET', KEYS[1])) or 0) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class LocalListCacheBackend():
+    ## In-process storage, every gunicorn worker keeps (and invalidates) its own entries
+    ## One entry per user holds its generation and pages, each page expires on its own
+
+    def __init__(self, maxsize: int = 1024):
+        self.cache = TTLCache(maxsize=maxsize)
+
+    async def get_generation(self, key: str) -> int:
+        entry = self.cache.get(key)
+        return entry["generation"] if entry else 0
+
+    async def get(self, key: str, generation: int, field: str):
+        entry = self.cache.get(key)
+        if not entry or entry["generation"] != generation:
+            return None
+        page = entry["pages"].get(field)
+        if page is None or time.monotonic() >= page[0]:
+            return None
+        return page[1]
+
+    async def set(self, key: str, generation: int, field: str, value, ttl: float):
+        entry = self.cache.get(key) or {"generation": 0, "pages": {}}
+        if entry["generation"] != generation:
+            return
+
+        now = time.monotonic()
+        pages = {name: page for name, page in entry["pages"].items() if page[0] > now}
+        pages[field] = (now + ttl, value)
+        self.cache.set(key, {"generation": generation, "pages": pages}, ttl=ttl)
+
+    async def invalidate(self, key: str, ttl: float):
+        generation = await self.get_generation(key) + 1
+        self.cache.set(key, {"generation": generation, "pages": {}}, ttl=ttl * 2)
+
+    async def close(self):
+        pass
+
+
+class RedisListCacheBackend():
+    ## Shared storage, so an invalidation on one worker is seen by all of them
+    ## Each page is a key of its own under the user's generation; an invalidation increments the generation,
+    ## which orphans the older pages until they expire. The generation outlives every page stored under it
+
+    def __init__(self, url: str):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise ValueError("The redis package is required for a shared conversation list cache") from e
+        self.client = redis.from_url(url)
+        self.set_page = self.client.register_script(REDIS_SET_PAGE_SCRIPT)
+
+    @staticmethod
+    def generation_key(key: str) -> str:
+        return f"{key}:generation"
+
+    @staticmethod
+    def page_key(key: str, generation: int, field: str) -> str:
+        return f"{key}:{generation}:{field}"
+
+    async def get_generation(self, key: str) -> int:
+        generation = await self.client.get(self.generation_key(key))
+        return int(generation) if generation is not None else 0
+
+    async def get(self, key: str, generation: int, field: str):
+        value = await self.client.get(self.page_key(key, generation, field))
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, generation: int, field: str, value, ttl: float):
+        await self.set_page(
+            keys=[self.generation_key(key), self.page_key(key, generation, field)],
+            args=[generation, json.dumps(value), max(int(ttl), 1), max(int(ttl), 1) * 2],
+        )
+
+    async def invalidate(self, key: str, ttl: float):
+        generation_key = self.generation_key(key)
+        await self.client.pipeline(transaction=True).incr(generation_key).expire(generation_key, max(int(ttl), 1) * 2).execute()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class ConversationListCache():
+    ## Read-through cache of /history/list pages per container and user
+    ## Every write to a user's history invalidates all of their cached pages; cache errors never fail a request
+    ## Readers take the generation before loading a page, so a page loaded across an invalidation is not stored
+
+    def __init__(self, backend, ttl: float = 30):
+        self.backend = backend
+        self.ttl = ttl
+
+    @staticmethod
+    def key(container_name: str, user_id: str) -> str:
+        ## the hash tag keeps all keys of a user in one Redis cluster slot
+        return f"history:list:{{{container_name}:{user_id}}}"
+
+    async def generation(self, container_name: str, user_id: str):
+        ## None when the cache is unavailable, the page is then neither read nor stored
+        try:
+            return await self.backend.get_generation(self.key(container_name, user_id))
+        except Exception:
+            logging.exception("Exception while reading the conversation list cache")
+            return None
+
+    async def get(self, container_name: str, user_id: str, generation: int, page: str):
+        try:
+            return await self.backend.get(self.key(container_name, user_id), generation, page)
+        except Exception:
+            logging.exception("Exception while reading the conversation list cache")
+            return None
+
+    async def set(self, container_name: str, user_id: str, generation: int, page: str, value):
+        try:
+            await self.backend.set(self.key(container_name, user_id), generation, page, value, self.ttl)
+        except Exception:
+            logging.exception("Exception while writing the conversation list cache")
+
+    async def invalidate(self, container_name: str, user_id: str):
+        try:
+            await self.backend.invalidate(self.key(container_name, user_id), self.ttl)
+        except Exception:
+            logging.exception("Exception while invalidating the conversation list cache")
+
+    async def close(self):
+        await self.backend.close()
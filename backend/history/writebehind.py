@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from azure.cosmos import exceptions
+
+# Cosmos rejects transactional batches with more operations than this
+MAX_BATCH_OPERATIONS = 100
+
+
+class HistoryWriteQueue():
+    ## Per-worker write-behind queue for chat history writes
+    ## Each write is a list of batch operations for one partition key (user_id); queued writes of
+    ## the same partition are committed together as transactional batches, in the order received
+
+    def __init__(self, flush_interval: float = 0.2, max_retries: int = 5):
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue()
+        self.in_flight = 0
+        ## writes given up on, and how many of them because their conversation no longer exists
+        self.dropped = 0
+        self.dropped_not_found = 0
+        self._task = None
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize() + self.in_flight
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, container_client, partition_key, operations: list):
+        self.start()
+        self.queue.put_nowait((container_client, partition_key, operations))
+
+    async def close(self):
+        ## flush everything that was queued before the worker exits
+        if self._task:
+            self.queue.put_nowait(None)
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            writes = [await self.queue.get()]
+            await asyncio.sleep(self.flush_interval)
+            while not self.queue.empty():
+                writes.append(self.queue.get_nowait())
+
+            if None in writes:
+                closing = True
+                writes = [write for write in writes if write is not None]
+
+            self.in_flight = len(writes)
+            try:
+                await self._flush(writes)
+            except Exception:
+                logging.exception("Exception while flushing chat history writes")
+            self.in_flight = 0
+            logging.debug(f"Flushed {len(writes)} chat history writes, {self.depth} queued")
+
+    async def _flush(self, writes):
+        partitions = {}
+        for container_client, partition_key, operations in writes:
+            partitions.setdefault((id(container_client), partition_key), []).append(
+                (container_client, partition_key, operations)
+            )
+
+        await asyncio.gather(
+            *[self._flush_partition(partition_writes) for partition_writes in partitions.values()]
+        )
+
+    async def _flush_partition(self, writes):
+        container_client, partition_key, _ = writes[0]
+        ## a single write never spans two batches
+        batches = [[]]
+        for write in writes:
+            batch_size = sum(len(operations) for _, _, operations in batches[-1])
+            if batches[-1] and batch_size + len(write[2]) > MAX_BATCH_OPERATIONS:
+                batches.append([])
+            batches[-1].append(write)
+
+        for batch in batches:
+            try:
+                await self._execute(
+                    container_client,
+                    partition_key,
+                    [operation for _, _, operations in batch for operation in operations],
+                )
+            except exceptions.CosmosBatchOperationError as e:
+                if len(batch) == 1:
+                    self._drop(partition_key, e)
+                    continue
+
+                ## one failing operation rolls the whole batch back, so retry the writes one by one
+                for _, _, operations in batch:
+                    try:
+                        await self._execute(container_client, partition_key, operations)
+                    except Exception as e:
+                        self._drop(partition_key, e)
+            except Exception as e:
+                self._drop(partition_key, e, count=len(batch))
+
+    def _drop(self, partition_key, error, count: int = 1):
+        self.dropped += count
+        status_code = getattr(error, "status_code", None)
+        if isinstance(error, exceptions.CosmosBatchOperationError):
+            ## the status of the operation that failed the batch
+            responses = error.operation_responses or []
+            if error.error_index is not None and error.error_index < len(responses):
+                status_code = responses[error.error_index].get("statusCode")
+        if status_code == 404:
+            ## the conversation was deleted before its messages were written
+            self.dropped_not_found += count
+            logging.warning(f"Dropping chat history write for partition {partition_key}: conversation not found")
+        else:
+            logging.error(f"Dropping {count} chat history write(s) for partition {partition_key}", exc_info=error)
+
+    async def _execute(self, container_client, partition_key, operations):
+        attempt = 0
+        while True:
+            try:
+                return await container_client.execute_item_batch(
+                    batch_operations=operations, partition_key=partition_key
+                )
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 429 or attempt >= self.max_retries:
+                    raise
+                retry_after_ms = e.headers.get("x-ms-retry-after-ms")
+                delay = float(retry_after_ms) / 1000 if retry_after_ms else 2 ** attempt
+                attempt += 1
+                await asyncio.sleep(delay)
@@ -0,0 +1,49 @@
+import logging
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    logging.debug("h2 is not installed, upstream HTTP clients fall back to HTTP/1.1")
+    HTTP2_AVAILABLE = False
+
+
+def get_origin(url: str):
+    url = httpx.URL(url)
+    return (url.scheme, url.host, url.port)
+
+
+class HttpClientPool():
+    ## One httpx.AsyncClient per upstream host, shared by every request served by the worker
+
+    def __init__(self, max_connections: int = 20, max_keepalive_connections: int = 10, keepalive_expiry: float = 30.0, timeout: float = 30.0):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.default_timeout = timeout
+        self.timeouts = {}
+        self.clients = {}
+
+    def configure(self, url: str, timeout: float):
+        self.timeouts[get_origin(url)] = timeout
+
+    def get_client(self, url: str) -> httpx.AsyncClient:
+        origin = get_origin(url)
+        client = self.clients.get(origin)
+        if not client:
+            client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=self.limits,
+                timeout=self.timeouts.get(origin, self.default_timeout),
+            )
+            self.clients[origin] = client
+        return client
+
+    async def close(self):
+        clients = list(self.clients.values())
+        self.clients = {}
+        for client in clients:
+            await client.aclose()
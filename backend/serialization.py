@@ -0,0 +1,97 @@
+import dataclasses
+import json
+import re
+from quart.json.provider import DefaultJSONProvider
+
+# orjson is optional; without it everything is encoded by the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Escapes of characters above U+FFFF left by the backslashreplace error handler
+ASTRAL_ESCAPE = re.compile(rb"\\U([0-9a-f]{8})")
+
+# json.dumps options the provider maps to orjson; any other option keeps the stdlib path
+COMPACT_SEPARATORS = (",", ":")
+
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if dataclasses.is_dataclass(o):
+            return dataclasses.asdict(o)
+        return super().default(o)
+
+
+def _default(o):
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def _surrogate_pair(match):
+    code_point = int(match.group(1), 16) - 0x10000
+    return b"\\u%04x\\u%04x" % (0xD800 + (code_point >> 10), 0xDC00 + (code_point & 0x3FF))
+
+
+def escape_non_ascii(encoded: bytes) -> bytes:
+    ## the output of json.dumps with ensure_ascii, from UTF-8 JSON text without encoding it again
+    ## backslashreplace writes \xNN, \uNNNN and \UNNNNNNNN, which JSON only knows as \u00NN, \uNNNN and a
+    ## surrogate pair. The text's own escaped backslashes are set aside first, so no other escape reads as \x or \U
+    escaped = encoded.replace(b"\\\\", b"\x00").decode("utf-8").encode("ascii", "backslashreplace")
+    escaped = escaped.replace(b"\\x", b"\\u00")
+    if b"\\U" in escaped:
+        escaped = ASTRAL_ESCAPE.sub(_surrogate_pair, escaped)
+    return escaped.replace(b"\x00", b"\\\\")
+
+
+def decode(encoded: bytes, ensure_ascii: bool) -> str:
+    if ensure_ascii and not encoded.isascii():
+        encoded = escape_non_ascii(encoded)
+    return encoded.decode("utf-8")
+
+
+def dumps(obj, ensure_ascii: bool = False) -> str:
+    ## compact JSON text, with dataclasses encoded as dicts
+    if orjson:
+        try:
+            encoded = orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            ## e.g. integers wider than 64 bits, which the stdlib can still encode
+            pass
+        else:
+            return decode(encoded, ensure_ascii)
+    return json.dumps(obj, cls=JSONEncoder, ensure_ascii=ensure_ascii, separators=COMPACT_SEPARATORS)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    ## Quart JSON provider (jsonify, response bodies) that encodes with orjson when it is installed
+    ## The compact and indented output of response() map to orjson options; other json.dumps options keep the stdlib path
+
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs) -> str:
+        options = dict(kwargs)
+        separators = options.pop("separators", None)
+        indent = options.pop("indent", None)
+        sort_keys = options.pop("sort_keys", self.sort_keys)
+        ensure_ascii = options.pop("ensure_ascii", self.ensure_ascii)
+        default = options.pop("default", self.default)
+        if indent is None:
+            supported = separators is None or tuple(separators) == COMPACT_SEPARATORS
+        else:
+            supported = indent == 2 and separators is None
+        if orjson is None or options or not supported:
+            return super().dumps(obj, **kwargs)
+
+        ## datetimes are passed to the default function, so they keep Quart's HTTP date format
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            encoded = orjson.dumps(obj, default=default, option=option)
+        except TypeError:
+            return super().dumps(obj, **kwargs)
+        return decode(encoded, ensure_ascii)
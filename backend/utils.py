@@ -1,8 +1,11 @@
 import os
 import json
+import asyncio
+import time
+import base64
+import hashlib
 import logging
-import requests
-import dataclasses
+from backend.serialization import JSONEncoder, dumps
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -12,21 +15,158 @@ AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
     "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
 )
 
+# Data source fields that hold credentials, at any depth
+SECRET_PARAMS = {
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+}
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
+# Stream protocol v2, for clients that ask for it with this Accept type or ?stream_format=v2
+STREAM_V2_MIMETYPE = "application/vnd.chat-stream.v2+json-lines"
 
 
-async def format_as_ndjson(r):
+async def format_as_ndjson(r, coalesce_interval_ms=0, coalesce_max_bytes=1024, stream_version=1):
+    # With a coalesce interval, consecutive assistant content deltas are sent as one frame
+    if coalesce_interval_ms > 0:
+        r = coalesce_stream_deltas(r, coalesce_interval_ms, coalesce_max_bytes)
+    if stream_version == 2:
+        r = compact_stream_frames(r)
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            # ASCII only, so no character is split across the network chunks the client decodes
+            yield dumps(event, ensure_ascii=True) + "\n"
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
-        yield json.dumps({"error": str(error)})
+        yield dumps({"error": str(error)}, ensure_ascii=True)
+
+
+def is_content_delta(event):
+    # A frame that carries nothing but assistant content, so it can be merged with its neighbours
+    if not event or not event.get("choices"):
+        return False
+    messages = event["choices"][0].get("messages", [])
+    return (
+        len(messages) == 1
+        and messages[0].get("role") == "assistant"
+        and set(messages[0]) == {"role", "content"}
+    )
+
+
+async def coalesce_stream_deltas(r, interval_ms, max_bytes):
+    # Merges consecutive content deltas into one frame, sent interval_ms after its first
+    # delta or once it holds max_bytes of content, whichever comes first. Any other frame
+    # (tool and context messages, the final frame) flushes the pending one and is sent at once
+    loop = asyncio.get_running_loop()
+    events = r.__aiter__()
+    pending = None
+    pending_bytes = 0
+    deadline = None
+    next_event = None
+    try:
+        while True:
+            # The same __anext__ is awaited across timeouts, so the stream is never cancelled
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+            timeout = None if pending is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_event}, timeout=timeout)
+            if not done:
+                yield pending
+                pending = None
+                continue
+
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                next_event = None
+                break
+            except Exception:
+                # send what was already received before the error is reported
+                next_event = None
+                if pending is not None:
+                    yield pending
+                raise
+            next_event = None
+
+            if is_content_delta(event):
+                content = event["choices"][0]["messages"][0]["content"]
+                if pending is None:
+                    message = dict(event["choices"][0]["messages"][0])
+                    pending = {**event, "choices": [{**event["choices"][0], "messages": [message]}]}
+                    pending_bytes = 0
+                    deadline = loop.time() + interval_ms / 1000
+                else:
+                    pending["choices"][0]["messages"][0]["content"] += content
+                pending_bytes += len(content.encode("utf-8"))
+                if pending_bytes >= max_bytes:
+                    yield pending
+                    pending = None
+                continue
+
+            if pending is not None:
+                yield pending
+                pending = None
+            yield event
+
+        if pending is not None:
+            yield pending
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+
+
+async def compact_stream_frames(r):
+    # Stream protocol v2. The first frame holds the envelope of the chunks ({"v": 2, "id", "model",
+    # "created", "object", "history_metadata"}); history_metadata is sent again only when it changes.
+    # Assistant content follows as {"delta": text} frames and the citations as {"citations": {...}},
+    # the context object format_stream_response passes through for v2, so it is encoded only once.
+    # Other messages are sent as {"message": {...}}
+    envelope_sent = False
+    history_metadata = None
+    async for event in r:
+        if not event:
+            continue
+        if "choices" not in event:
+            yield event
+            continue
+
+        metadata = event.get("history_metadata") or {}
+        if not envelope_sent:
+            yield {
+                "v": 2,
+                "id": event.get("id"),
+                "model": event.get("model"),
+                "created": event.get("created"),
+                "object": event.get("object"),
+                "history_metadata": metadata,
+            }
+            envelope_sent = True
+            history_metadata = dict(metadata)
+        elif metadata != history_metadata:
+            yield {"history_metadata": metadata}
+            history_metadata = dict(metadata)
+
+        for message in event["choices"][0].get("messages", []):
+            if message.get("role") == "tool":
+                yield {"citations": message.get("content")}
+            elif message.get("role") == "assistant" and set(message) == {"role", "content"}:
+                yield {"delta": message["content"]}
+            else:
+                yield {"message": message}
+
+
+def redact_secrets(obj):
+    # Copy of the dicts and lists in obj with every secret value masked; other values are shared
+    if isinstance(obj, dict):
+        return {
+            k: "*****" if k in SECRET_PARAMS and v else redact_secrets(v)
+            for k, v in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [redact_secrets(v) for v in obj]
+    return obj
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -36,41 +176,68 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+def get_token_expiry(userToken):
+    # Read the exp claim of a JWT without validating it; None if it can't be read
+    try:
+        payload = userToken.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return None
+
 
+async def fetchUserGroups(userToken, http_client):
+    # Follow the @odata.nextLink pages of the group membership
+    # Raises when Graph fails (e.g. 429), so a failed lookup is never cached as "no groups"
+    endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
     headers = {"Authorization": "bearer " + userToken}
-    try:
-        r = requests.get(endpoint, headers=headers)
+    userGroups = []
+    while endpoint:
+        r = await http_client.get(endpoint, headers=headers)
         if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+            raise Exception(f"Error fetching user groups: {r.status_code} {r.text}")
 
         r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+        userGroups.extend(r["value"])
+        endpoint = r.get("@odata.nextLink")
+
+    return userGroups
 
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
 
+async def generateFilterString(userToken, http_client, group_cache=None, cache_key=None, filter_cache=None):
+    # The filter only depends on the user token, so reuse it until the token expires
+    token_hash = hashlib.sha256(userToken.encode()).hexdigest()
+    if filter_cache is not None:
+        filter_string = filter_cache.get(token_hash)
+        if filter_string:
+            return filter_string
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    # Get list of groups user is a member of, from the cache when possible
+    # A failed lookup matches no groups for this request only
+    try:
+        if group_cache is not None and cache_key:
+            userGroups = await group_cache.get_or_load(
+                cache_key, lambda: fetchUserGroups(userToken, http_client)
+            )
+        else:
+            userGroups = await fetchUserGroups(userToken, http_client)
+    except Exception:
+        logging.exception("Exception in fetchUserGroups")
+        userGroups = []
 
     # Construct filter string
     if not userGroups:
         logging.debug("No user groups found")
 
     group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    filter_string = f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+
+    token_expiry = get_token_expiry(userToken)
+    if filter_cache is not None and userGroups and token_expiry:
+        ttl = token_expiry - time.time()
+        if ttl > 0:
+            filter_cache.set(token_hash, filter_string, ttl=ttl)
+    return filter_string
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, message_uuid=None):
@@ -90,7 +257,7 @@ def format_non_streaming_response(chatCompletion, history_metadata, message_uuid
                 response_obj["choices"][0]["messages"].append(
                     {
                         "role": "tool",
-                        "content": json.dumps(message.context),
+                        "content": dumps(message.context),
                     }
                 )
             response_obj["choices"][0]["messages"].append(
@@ -104,7 +271,7 @@ def format_non_streaming_response(chatCompletion, history_metadata, message_uuid
     return {}
 
 
-def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=None):
+def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=None, stream_version=1):
     response_obj = {
         "id": chatCompletionChunk.id,
         "model": chatCompletionChunk.model,
@@ -118,7 +285,10 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
         delta = chatCompletionChunk.choices[0].delta
         if delta:
             if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
+                # the tool message content is a JSON string of the citations, as the frontend and history expect;
+                # the v2 stream sends the context object itself
+                content = delta.context if stream_version == 2 else dumps(delta.context)
+                messageObj = {"role": "tool", "content": content}
                 response_obj["choices"][0]["messages"].append(messageObj)
                 return response_obj
             if delta.role == "assistant" and hasattr(delta, "context"):
@@ -38,9 +38,20 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
     return chatHistorySampleData;
 }
 
+// Cursor of the next /history/list page (X-Next-Cursor), per container and the offset it continues from.
+// Callers page by offset; pages with a known cursor are read by continuation token instead of OFFSET
+const historyListCursors = new Map<string, string>();
+
 export const historyList = async (offset=0): Promise<Conversation[] | null> => {
     const containerName = getUseCaseName();
-    const response = await fetch(`/history/list?offset=${offset}&containerName=${containerName}`, {
+    if (offset === 0) {
+        Array.from(historyListCursors.keys())
+            .filter((key) => key.startsWith(`${containerName}:`))
+            .forEach((key) => historyListCursors.delete(key));
+    }
+    const cursor = historyListCursors.get(`${containerName}:${offset}`);
+    const page = cursor ? `cursor=${encodeURIComponent(cursor)}` : `offset=${offset}`;
+    const response = await fetch(`/history/list?${page}&containerName=${containerName}`, {
         method: "GET",
     }).then(async (res) => {
         const payload = await res.json();
@@ -48,6 +59,10 @@ export const historyList = async (offset=0): Promise<Conversation[] | null> => {
             console.error("There was an issue fetching your data.");
             return null;
         }
+        const nextCursor = res.headers.get("X-Next-Cursor");
+        if (nextCursor) {
+            historyListCursors.set(`${containerName}:${offset + payload.length}`, nextCursor);
+        }
         const conversations: Conversation[] = await Promise.all(payload.map(async (conv: any) => {
             let convMessages: ChatMessage[] = [];
             convMessages = await historyRead(conv.id)
@@ -194,6 +194,8 @@ const Chat = () => {
             const response = await conversationApi(request, abortController.signal);
             if (response?.body) {
                 const reader = response.body.getReader();
+                // one decoder for the whole stream, so a character split across two chunks is decoded intact
+                const decoder = new TextDecoder("utf-8");
 
                 let runningText = "";
                 while (true) {
@@ -201,7 +203,7 @@ const Chat = () => {
                     const { done, value } = await reader.read();
                     if (done) break;
 
-                    var text = new TextDecoder("utf-8").decode(value);
+                    var text = decoder.decode(value, { stream: true });
                     const objects = text.split("\n");
                     objects.forEach((obj) => {
                         try {
@@ -344,6 +346,8 @@ const Chat = () => {
             }
             if (response?.body) {
                 const reader = response.body.getReader();
+                // one decoder for the whole stream, so a character split across two chunks is decoded intact
+                const decoder = new TextDecoder("utf-8");
 
                 let runningText = "";
                 while (true) {
@@ -351,7 +355,7 @@ const Chat = () => {
                     const { done, value } = await reader.read();
                     if (done) break;
 
-                    var text = new TextDecoder("utf-8").decode(value);
+                    var text = decoder.decode(value, { stream: true });
                     const objects = text.split("\n");
                     objects.forEach((obj) => {
                         try {
@@ -0,0 +1,109 @@
+import argparse
+import random
+import statistics
+import time
+
+from azure.cosmos import CosmosClient
+from azure.identity import AzureDeveloperCliCredential
+
+USECASE_QUERY_INTERPOLATED = "SELECT VALUE c.Frontend.formData.useCaseName FROM c where c.use_case_id in ({use_case_ids}) and c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
+USECASE_QUERY_PARAMETERIZED = "SELECT VALUE c.Frontend.formData.useCaseName FROM c where ARRAY_CONTAINS(@useCaseIds, c.use_case_id) and c.Frontend.formData.uiRequired = true order by c.Frontend.formData.createdAt DESC"
+GROUP_QUERY_INTERPOLATED = "SELECT * FROM c WHERE (SELECT VALUE COUNT(1) FROM g IN c.ad_groups WHERE g.name IN ({group_names})) = {group_count}"
+GROUP_QUERY_PARAMETERIZED = "SELECT * FROM c WHERE (SELECT VALUE COUNT(1) FROM g IN c.ad_groups WHERE ARRAY_CONTAINS(@groupNames, g.name)) = @groupCount"
+
+
+def run_query(container, query, parameters=None):
+    ## latency in ms and request charge summed over every page of the query
+    charge = 0.0
+    started = time.perf_counter()
+    pages = container.query_items(
+        query=query, parameters=parameters or [], enable_cross_partition_query=True
+    ).by_page()
+    for page in pages:
+        list(page)
+        charge += float(container.client_connection.last_response_headers.get("x-ms-request-charge", 0))
+    return (time.perf_counter() - started) * 1000, charge
+
+
+def summarize(name, results):
+    latencies = sorted(latency for latency, _ in results)
+    charges = [charge for _, charge in results]
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    print(
+        f"{name:<28} median {statistics.median(latencies):8.1f} ms   p95 {p95:8.1f} ms   "
+        f"mean {statistics.mean(charges):7.2f} RU"
+    )
+
+
+def benchmark_usecases(container, iterations):
+    use_case_ids = [
+        item for item in container.query_items(
+            query="SELECT DISTINCT VALUE c.use_case_id FROM c", enable_cross_partition_query=True
+        ) if isinstance(item, (int, float))
+    ]
+    if not use_case_ids:
+        print("No use cases found, skipping the use case query")
+        return
+
+    interpolated, parameterized = [], []
+    for _ in range(iterations):
+        sample = random.sample(use_case_ids, random.randint(1, min(len(use_case_ids), 10)))
+        interpolated.append(run_query(
+            container, USECASE_QUERY_INTERPOLATED.format(use_case_ids=", ".join(f"{int(id)}" for id in sample))
+        ))
+        parameterized.append(run_query(
+            container, USECASE_QUERY_PARAMETERIZED, [{"name": "@useCaseIds", "value": [int(id) for id in sample]}]
+        ))
+    summarize("get_usecases interpolated", interpolated)
+    summarize("get_usecases parameterized", parameterized)
+
+
+def benchmark_groups(container, iterations):
+    group_names = list(container.query_items(
+        query="SELECT DISTINCT VALUE g.name FROM c JOIN g IN c.ad_groups", enable_cross_partition_query=True
+    ))
+    if not group_names:
+        print("No AD groups found, skipping the access control query")
+        return
+
+    interpolated, parameterized = [], []
+    for _ in range(iterations):
+        sample = random.sample(group_names, random.randint(1, min(len(group_names), 5)))
+        interpolated.append(run_query(
+            container,
+            GROUP_QUERY_INTERPOLATED.format(
+                group_names=", ".join(f"'{name}'" for name in sample), group_count=len(sample)
+            ),
+        ))
+        parameterized.append(run_query(
+            container,
+            GROUP_QUERY_PARAMETERIZED,
+            [{"name": "@groupNames", "value": sample}, {"name": "@groupCount", "value": len(sample)}],
+        ))
+    summarize("group filter interpolated", interpolated)
+    summarize("group filter parameterized", parameterized)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare RU and latency of the interpolated and parameterized use case queries",
+        epilog="Example: benchmark_usecase_queries.py --account myaccount --database db --usecase-container usecases",
+    )
+    parser.add_argument("--account", required=True, help="Required. Name of the CosmosDB account.")
+    parser.add_argument("--database", required=True, help="Required. Database of the use case container.")
+    parser.add_argument("--usecase-container", required=False, help="Optional. Use case container to benchmark.")
+    parser.add_argument("--access-control-database", required=False, help="Optional. Database of the tech hub container.")
+    parser.add_argument("--access-control-container", required=False, help="Optional. Tech hub container to benchmark.")
+    parser.add_argument("--iterations", type=int, default=50, help="Optional. Queries per variant, defaults to 50.")
+    parser.add_argument("--key", required=False, help="Optional. Account key, the Azure Developer CLI login is used otherwise.")
+    args = parser.parse_args()
+
+    credential = args.key or AzureDeveloperCliCredential()
+    client = CosmosClient(f"https://{args.account}.documents.azure.com:443/", credential=credential)
+
+    if args.usecase_container:
+        database = client.get_database_client(args.database)
+        benchmark_usecases(database.get_container_client(args.usecase_container), args.iterations)
+    if args.access_control_container:
+        database = client.get_database_client(args.access_control_database or args.database)
+        benchmark_groups(database.get_container_client(args.access_control_container), args.iterations)
@@ -0,0 +1,103 @@
+import argparse
+import os
+import sys
+
+from azure.cosmos import CosmosClient, PartitionKey
+from azure.identity import AzureDeveloperCliCredential
+
+# The policy is shared with the startup check of the app
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from backend.history.cosmosdbservice import (  # noqa: E402
+    HISTORY_INDEXING_POLICY,
+    indexing_policy_differences,
+)
+
+# Only containers that hold chat history documents get the history indexing policy
+HISTORY_DOCUMENT_TYPES = {"conversation", "message"}
+HISTORY_SAMPLE_SIZE = 100
+
+
+def is_history_container(container):
+    ## samples the documents; other containers (use cases, access control) rely on their own indexes
+    sample = container.query_items(
+        query=f"SELECT TOP {HISTORY_SAMPLE_SIZE} c.type FROM c", enable_cross_partition_query=True
+    )
+    return all(document.get("type") in HISTORY_DOCUMENT_TYPES for document in sample)
+
+
+def apply_indexing_policy(database, container_name, check_only=False):
+    container = database.get_container_client(container_name)
+    if not is_history_container(container):
+        print(f"{container_name}: holds documents other than conversations and messages, skipped")
+        return
+
+    properties = container.read()
+    differences = indexing_policy_differences(properties.get("indexingPolicy", {}))
+    if not differences:
+        print(f"{container_name}: indexing policy is up to date")
+        return
+
+    for difference in differences:
+        print(f"{container_name}: {difference}")
+    if check_only:
+        return
+
+    partition_key = properties["partitionKey"]
+    paths = partition_key["paths"]
+    database.replace_container(
+        container,
+        partition_key=PartitionKey(
+            path=paths[0] if len(paths) == 1 else paths,
+            kind=partition_key.get("kind", "Hash"),
+            version=partition_key.get("version", 2),
+        ),
+        indexing_policy=HISTORY_INDEXING_POLICY,
+        default_ttl=properties.get("defaultTtl"),
+    )
+    print(f"{container_name}: indexing policy replaced, the index is rebuilt in the background")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Apply the chat history indexing policy to CosmosDB containers",
+        epilog="Example: cosmos_indexing_policy.py --account myaccount --database db_conversation_history --container conversations",
+    )
+    parser.add_argument(
+        "--account",
+        required=True,
+        help="Required. Name of the CosmosDB account.",
+    )
+    parser.add_argument(
+        "--database",
+        required=True,
+        help="Required. Name of the chat history database.",
+    )
+    parser.add_argument(
+        "--container",
+        action="append",
+        help="Chat history container to update, can be repeated. Defaults to AZURE_COSMOSDB_CONVERSATIONS_CONTAINER.",
+    )
+    parser.add_argument(
+        "--key",
+        required=False,
+        help="Optional. Account key, the Azure Developer CLI login is used otherwise.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Optional. Only report the differences, do not replace any policy.",
+    )
+    args = parser.parse_args()
+
+    container_names = args.container or [
+        name for name in [os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")] if name
+    ]
+    if not container_names:
+        parser.error("--container is required when AZURE_COSMOSDB_CONVERSATIONS_CONTAINER is not set")
+
+    credential = args.key or AzureDeveloperCliCredential()
+    client = CosmosClient(f"https://{args.account}.documents.azure.com:443/", credential=credential)
+    database = client.get_database_client(args.database)
+
+    for container_name in container_names:
+        apply_indexing_policy(database, container_name, check_only=args.check)
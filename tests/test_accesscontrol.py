@@ -0,0 +1,63 @@
+import pytest
+from backend.history.accesscontrol import AccessControlIndex
+
+
+def usecase(rid, use_case_id, name, created_at, ui_required=True):
+    return {
+        "_rid": rid,
+        "use_case_id": use_case_id,
+        "Frontend": {"formData": {"useCaseName": name, "uiRequired": ui_required, "createdAt": created_at}},
+    }
+
+
+def access(rid, use_case_id=None, groups=(), user=None, role=None):
+    return {"_rid": rid, "user": user, "role": role, "use_case_id": use_case_id, "ad_groups": [{"name": group} for group in groups]}
+
+
+class FakeContainer:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def query_items(self, query):
+        for document in self.documents:
+            yield document
+
+
+@pytest.mark.asyncio
+async def test_load_and_lookups():
+    index = AccessControlIndex(
+        access_control_container=FakeContainer([
+            access("a1", user="admin@contoso.com", role="Admin"),
+            access("a2", use_case_id=1, groups=["Finance", "Legal"]),
+            access("a3", use_case_id=2, groups=["Finance"]),
+        ]),
+        usecase_container=FakeContainer([
+            usecase("u1", 1, "Contracts", "2024-01-01"),
+            usecase("u2", 2, "Budgets", "2024-02-01"),
+            usecase("u3", 3, "Hidden", "2024-03-01", ui_required=False),
+        ]),
+    )
+    await index.load()
+
+    assert index.is_admin("admin@contoso.com")
+    assert not index.is_admin("user@contoso.com")
+    assert index.get_usecase_ids(["Finance"]) == {1, 2}
+    assert index.get_usecase_ids(["Finance", "Legal"]) == {1}
+    assert index.get_usecase_ids(["Finance", "HR"]) == set()
+    assert index.get_usecase_ids([]) == set()
+    assert index.get_usecase_names() == ["Budgets", "Contracts"]
+    assert index.get_usecase_names({1}) == ["Contracts"]
+    assert index.get_all_usecase_names() == {"Budgets", "Contracts", "Hidden"}
+
+
+def test_changes_replace_previous_versions():
+    index = AccessControlIndex()
+    index.apply_access_control_changes([access("a1", user="someone@contoso.com", role="Admin"), access("a2", 1, ["Finance"])])
+    index.apply_access_control_changes([access("a1", user="someone@contoso.com", role="Reader"), access("a2", 1, ["Legal"])])
+    assert not index.is_admin("someone@contoso.com")
+    assert index.get_usecase_ids(["Finance"]) == set()
+    assert index.get_usecase_ids(["Legal"]) == {1}
+
+    index.apply_usecase_changes([usecase("u1", 1, "Contracts", "2024-01-01")])
+    index.apply_usecase_changes([usecase("u1", 1, "Contracts", "2024-01-01", ui_required=False)])
+    assert index.get_usecase_names() == []
@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from backend.cache import TTLCache
+
+
+def test_entries_expire():
+    cache = TTLCache(ttl=0)
+    cache.set("user", ["group"])
+    assert cache.get("user") is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+
+def test_empty_results_use_negative_ttl():
+    cache = TTLCache(ttl=300, negative_ttl=0)
+    cache.set("user", [])
+    assert cache.get("user") is None
+
+
+@pytest.mark.asyncio
+async def test_get_or_load_is_single_flight():
+    cache = TTLCache()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return ["group"]
+
+    results = await asyncio.gather(*[cache.get_or_load("user", loader) for _ in range(10)])
+    assert results == [["group"]] * 10
+    assert calls == 1
+    assert await cache.get_or_load("user", loader) == ["group"]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_get_or_load_does_not_cache_errors():
+    cache = TTLCache()
+
+    async def loader():
+        raise ValueError("throttled")
+
+    with pytest.raises(ValueError):
+        await cache.get_or_load("user", loader)
+    assert cache.get("user") is None
@@ -0,0 +1,54 @@
+import pytest
+from backend.history.changefeed import ChangeFeedWatcher
+
+
+class FakeContainer:
+    def __init__(self):
+        self.changes = []
+        self.start_times = []
+
+    async def feed(self):
+        for item in self.changes:
+            yield item
+
+    def query_items_change_feed(self, start_time=None):
+        self.start_times.append(start_time)
+        return self.feed()
+
+
+@pytest.mark.asyncio
+async def test_listeners_are_called_on_changes():
+    container = FakeContainer()
+    watcher = ChangeFeedWatcher(container)
+    seen = []
+    watcher.add_listener(seen.append)
+
+    async def async_listener(changed):
+        seen.append(len(changed))
+
+    watcher.add_listener(async_listener)
+
+    assert await watcher.poll() == []
+    assert watcher.version == 0
+
+    container.changes = [{"id": "usecase-1"}]
+    await watcher.poll()
+    assert watcher.version == 1
+    assert seen == [[{"id": "usecase-1"}], 1]
+    assert container.start_times[1] > container.start_times[0]
+
+
+@pytest.mark.asyncio
+async def test_failing_listener_does_not_stop_others():
+    container = FakeContainer()
+    container.changes = [{"id": "usecase-1"}]
+    watcher = ChangeFeedWatcher(container)
+    seen = []
+
+    def failing_listener(changed):
+        raise ValueError("boom")
+
+    watcher.add_listener(failing_listener)
+    watcher.add_listener(seen.append)
+    await watcher.poll()
+    assert seen == [[{"id": "usecase-1"}]]
@@ -0,0 +1,428 @@
+import asyncio
+
+import pytest
+from azure.cosmos import exceptions
+from backend.history.cosmosdbservice import (
+    HISTORY_INDEXING_POLICY,
+    CosmosConversationClient,
+    CosmosConversationClientRegistry,
+    indexing_policy_differences,
+)
+from backend.history.writebehind import MAX_BATCH_OPERATIONS
+from backend.history import cosmosdbservice
+
+
+class FakeContainer:
+    def __init__(self, items=()):
+        self.items = {item["id"]: dict(item) for item in items}
+        self.calls = []
+        self.query_results = None
+
+    async def read_item(self, item, partition_key):
+        self.calls.append("read_item")
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        return dict(self.items[item])
+
+    async def delete_item(self, item, partition_key):
+        self.calls.append("delete_item")
+        if self.items.pop(item, None) is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+
+    async def upsert_item(self, item):
+        self.calls.append("upsert_item")
+        self.items[item["id"]] = dict(item)
+        return item
+
+    async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
+        self.calls.append("patch_item")
+        return self.apply_patch(item, patch_operations, filter_predicate)
+
+    def apply_patch(self, item, patch_operations, filter_predicate=None):
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+        document = self.items[item]
+        if filter_predicate and not matches(document, filter_predicate):
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="precondition failed")
+        for operation in patch_operations:
+            document[operation["path"].lstrip("/")] = operation["value"]
+        return dict(document)
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        self.calls.append("execute_item_batch")
+        ## all or nothing, like a Cosmos transactional batch
+        snapshot = {item_id: dict(item) for item_id, item in self.items.items()}
+        for index, operation in enumerate(batch_operations):
+            kwargs = operation[2] if len(operation) > 2 else {}
+            try:
+                if operation[0] == "upsert":
+                    self.items[operation[1][0]["id"]] = dict(operation[1][0])
+                elif operation[0] == "delete":
+                    if self.items.pop(operation[1][0], None) is None:
+                        raise exceptions.CosmosResourceNotFoundError(status_code=404, message="not found")
+                else:
+                    self.apply_patch(*operation[1], **kwargs)
+            except exceptions.CosmosHttpResponseError as e:
+                self.items = snapshot
+                raise exceptions.CosmosBatchOperationError(
+                    error_index=index,
+                    headers={},
+                    status_code=e.status_code,
+                    message="batch failed",
+                    operation_responses=[{"statusCode": e.status_code}] * len(batch_operations),
+                )
+        return batch_operations
+
+    async def query_items(self, query, parameters, partition_key=None):
+        self.calls.append("query_items")
+        for item in self.query_results or []:
+            yield item
+
+
+def matches(document, filter_predicate):
+    ## understands the predicates built by CosmosConversationClient
+    if f"c.type = '{document['type']}'" not in filter_predicate:
+        return False
+    if "c.updatedAt <" in filter_predicate:
+        return document["updatedAt"] < filter_predicate.split("c.updatedAt < ")[1].strip('"')
+    if "c.title =" in filter_predicate:
+        return document["title"] == filter_predicate.split("c.title = ")[1].strip('"')
+    return True
+
+
+class FakeCosmosClient:
+    def __init__(self, container):
+        self.container = container
+        self.replaced = []
+
+    async def replace_container(self, container, partition_key, **kwargs):
+        self.replaced.append((partition_key, kwargs))
+
+    def get_database_client(self, database_name):
+        return self
+
+    def get_container_client(self, container_name):
+        return self.container
+
+
+def make_client(container):
+    return CosmosConversationClient(
+        cosmosdb_endpoint="https://example.documents.azure.com",
+        credential="key",
+        database_name="db",
+        container_name="conversations",
+        cosmosdb_client=FakeCosmosClient(container),
+    )
+
+
+conversation = {"id": "conv-1", "type": "conversation", "user_id": "user-1", "title": "Hello", "updatedAt": "2024-01-01T00:00:00"}
+
+
+@pytest.mark.asyncio
+async def test_create_message_patches_updated_at():
+    container = FakeContainer([conversation])
+    client = make_client(container)
+
+    message = await client.create_message("msg-1", "conv-1", "user-1", {"role": "user", "content": "hi"})
+    assert message["id"] == "msg-1"
+    assert container.calls == ["upsert_item", "patch_item"]
+    assert container.items["conv-1"]["updatedAt"] == message["createdAt"]
+    assert container.items["conv-1"]["title"] == "Hello"
+
+
+@pytest.mark.asyncio
+async def test_create_message_keeps_newer_updated_at():
+    container = FakeContainer([dict(conversation, updatedAt="2999-01-01T00:00:00")])
+    client = make_client(container)
+
+    message = await client.create_message("msg-1", "conv-1", "user-1", {"role": "user", "content": "hi"})
+    assert message["id"] == "msg-1"
+    assert container.items["conv-1"]["updatedAt"] == "2999-01-01T00:00:00"
+
+
+@pytest.mark.asyncio
+async def test_create_message_without_conversation():
+    client = make_client(FakeContainer())
+
+    result = await client.create_message("msg-1", "conv-1", "user-1", {"role": "user", "content": "hi"})
+    assert result == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_update_message_feedback():
+    container = FakeContainer([conversation, {"id": "msg-1", "type": "message", "user_id": "user-1", "feedback": ""}])
+    client = make_client(container)
+
+    updated = await client.update_message_feedback("user-1", "msg-1", "positive")
+    assert updated["feedback"] == "positive"
+    assert await client.update_message_feedback("user-1", "conv-1", "positive") is False
+    assert await client.update_message_feedback("user-1", "missing", "positive") is False
+    assert "upsert_item" not in container.calls
+
+
+@pytest.mark.asyncio
+async def test_update_conversation_title():
+    container = FakeContainer([conversation])
+    client = make_client(container)
+
+    assert await client.update_conversation_title("user-1", "conv-1", "Greeting", current_title="Other") is False
+    updated = await client.update_conversation_title("user-1", "conv-1", "Greeting")
+    assert updated["title"] == "Greeting"
+    assert await client.update_conversation_title("user-1", "missing", "Greeting") is False
+
+
+@pytest.mark.asyncio
+async def test_create_messages_is_one_batch():
+    container = FakeContainer([conversation])
+    client = make_client(container)
+
+    messages = await client.create_messages("conv-1", "user-1", [
+        ("tool-1", {"role": "tool", "content": "citations"}),
+        ("msg-1", {"role": "assistant", "content": "answer"}),
+    ])
+    assert container.calls == ["execute_item_batch"]
+    assert {"tool-1", "msg-1"} <= set(container.items)
+    assert container.items["conv-1"]["updatedAt"] == messages[-1]["createdAt"]
+
+
+@pytest.mark.asyncio
+async def test_create_messages_without_conversation_writes_nothing():
+    container = FakeContainer()
+    client = make_client(container)
+
+    result = await client.create_messages("conv-1", "user-1", [("msg-1", {"role": "assistant", "content": "answer"})])
+    assert result == "Conversation not found"
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_create_messages_keeps_newer_updated_at():
+    container = FakeContainer([dict(conversation, updatedAt="2999-01-01T00:00:00")])
+    client = make_client(container)
+
+    await client.create_messages("conv-1", "user-1", [("msg-1", {"role": "assistant", "content": "answer"})])
+    assert "msg-1" in container.items
+    assert container.items["conv-1"]["updatedAt"] == "2999-01-01T00:00:00"
+
+
+@pytest.mark.asyncio
+async def test_delete_messages_in_batches():
+    messages = [{"id": f"msg-{i}", "type": "message", "user_id": "user-1"} for i in range(250)]
+    container = FakeContainer([conversation] + messages)
+    container.query_results = [{"id": message["id"]} for message in messages]
+    client = make_client(container)
+
+    assert await client.delete_messages("conv-1", "user-1") == 250
+    assert container.calls.count("execute_item_batch") == 3
+    assert list(container.items) == ["conv-1"]
+
+
+@pytest.mark.asyncio
+async def test_delete_batch_falls_back_to_single_deletes():
+    container = FakeContainer([{"id": "msg-1", "type": "message"}])
+    container.query_results = [{"id": "msg-1"}, {"id": "msg-2"}]
+    client = make_client(container)
+
+    assert await client.delete_messages("conv-1", "user-1") == 2
+    assert container.calls.count("delete_item") == 2
+    assert container.items == {}
+
+
+@pytest.mark.asyncio
+async def test_delete_items_cancels_batches_when_the_query_fails():
+    container = FakeContainer()
+    started = asyncio.Event()
+    batches = []
+
+    async def execute_item_batch(batch_operations, partition_key):
+        batch = asyncio.current_task()
+        batches.append(batch)
+        started.set()
+        await asyncio.sleep(10)
+
+    async def query_items(query, parameters, partition_key=None):
+        for i in range(MAX_BATCH_OPERATIONS):
+            yield {"id": f"msg-{i}"}
+        await started.wait()
+        raise exceptions.CosmosHttpResponseError(status_code=503, message="unavailable")
+
+    container.execute_item_batch = execute_item_batch
+    container.query_items = query_items
+    client = make_client(container)
+
+    with pytest.raises(exceptions.CosmosHttpResponseError):
+        await client.delete_messages("conv-1", "user-1")
+    assert len(batches) == 1 and batches[0].cancelled()
+
+
+class FakePages:
+    def __init__(self, pages, continuation_token):
+        self.pages = pages
+        self.index = int(continuation_token or 0)
+        self.continuation_token = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.index >= len(self.pages):
+            raise StopAsyncIteration
+        page = self.pages[self.index]
+        self.index += 1
+        self.continuation_token = str(self.index) if self.index < len(self.pages) else None
+        return FakePage(page)
+
+
+class FakePage:
+    def __init__(self, items):
+        self.items = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakePagedQuery:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def by_page(self, continuation_token=None):
+        return FakePages(self.pages, continuation_token)
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_cursor():
+    container = FakeContainer()
+    container.query_items = lambda **kwargs: FakePagedQuery([[{"id": "conv-1"}], [{"id": "conv-2"}]])
+    client = make_client(container)
+
+    first, cursor = await client.get_conversations_page("user-1", limit=1)
+    assert first == [{"id": "conv-1"}]
+    assert cursor and cursor != "1"
+
+    second, cursor = await client.get_conversations_page("user-1", limit=1, cursor=cursor)
+    assert second == [{"id": "conv-2"}]
+    assert cursor is None
+
+    with pytest.raises(ValueError):
+        await client.get_conversations_page("user-1", limit=1, cursor="not base64!")
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_fills_short_pages():
+    container = FakeContainer()
+    page_sizes = []
+
+    def query_items(**kwargs):
+        page_sizes.append(kwargs["max_item_count"])
+        return FakePagedQuery([[{"id": "conv-1"}], [], [{"id": "conv-2"}], [{"id": "conv-3"}]])
+
+    container.query_items = query_items
+    client = make_client(container)
+
+    conversations, cursor = await client.get_conversations_page("user-1", limit=2)
+    assert conversations == [{"id": "conv-1"}, {"id": "conv-2"}]
+    assert page_sizes == [2, 1, 1]
+
+    conversations, cursor = await client.get_conversations_page("user-1", limit=2, cursor=cursor)
+    assert conversations == [{"id": "conv-3"}]
+    assert cursor is None
+
+
+@pytest.mark.asyncio
+async def test_get_conversation_is_a_point_read():
+    container = FakeContainer([conversation, {"id": "msg-1", "type": "message", "user_id": "user-1"}])
+    client = make_client(container)
+
+    assert (await client.get_conversation("user-1", "conv-1"))["title"] == "Hello"
+    assert await client.get_conversation("user-1", "msg-1") is None
+    assert await client.get_conversation("user-1", "missing") is None
+    assert set(container.calls) == {"read_item"}
+
+
+@pytest.mark.asyncio
+async def test_get_messages_projection():
+    container = FakeContainer()
+    queries = []
+
+    async def query_items(query, parameters, partition_key=None):
+        queries.append(query)
+        yield {"id": "msg-1"}
+
+    container.query_items = query_items
+    client = make_client(container)
+
+    await client.get_messages("user-1", "conv-1", fields=("id", "content"))
+    await client.get_messages("user-1", "conv-1")
+    assert queries[0].startswith("SELECT c.id, c.content FROM c")
+    assert queries[1].startswith("SELECT * FROM c")
+
+
+def test_indexing_policy_differences():
+    assert indexing_policy_differences(HISTORY_INDEXING_POLICY) == []
+
+    default_policy = {"includedPaths": [{"path": "/*"}], "excludedPaths": [{"path": '/"_etag"/?'}]}
+    differences = indexing_policy_differences(default_policy)
+    assert "path /* is not excluded" in differences
+    assert len([difference for difference in differences if "composite" in difference]) == 2
+
+
+@pytest.mark.asyncio
+async def test_check_indexing_policy():
+    container = FakeContainer()
+    properties = {"partitionKey": {"paths": ["/user_id"], "kind": "Hash"}, "indexingPolicy": {}}
+
+    async def read():
+        return properties
+
+    container.read = read
+    client = make_client(container)
+
+    assert await client.check_indexing_policy() is False
+    assert client.database_client.replaced == []
+
+    assert await client.check_indexing_policy(apply=True) is True
+    partition_key, kwargs = client.database_client.replaced[0]
+    assert partition_key.path == "/user_id"
+    assert kwargs["indexing_policy"] == HISTORY_INDEXING_POLICY
+
+
+@pytest.mark.asyncio
+async def test_usecase_and_group_queries_are_parameterized():
+    container = FakeContainer()
+    queries = []
+
+    async def query_items(query, parameters, partition_key=None):
+        queries.append((query, parameters))
+        yield {"use_case_id": 1}
+
+    container.query_items = query_items
+    client = make_client(container)
+
+    await client.get_usecases("user-1", 0, (1, 2))
+    await client.get_usecases("user-2", 0, (3,))
+    await client.get_access_control_by_group_name(["Finance", "Legal"], 2)
+    await client.get_access_control_by_group_name(["O'Brien"], 1)
+
+    assert queries[0][0] == queries[1][0]
+    assert queries[0][1] == [{"name": "@useCaseIds", "value": [1, 2]}]
+    assert queries[2][0] == queries[3][0]
+    assert "O'Brien" not in queries[3][0]
+    assert {"name": "@groupNames", "value": ["O'Brien"]} in queries[3][1]
+
+
+def test_registry_keeps_at_most_max_clients(monkeypatch):
+    monkeypatch.setattr(cosmosdbservice, "create_cosmos_client", lambda endpoint, credential: FakeCosmosClient(FakeContainer()))
+    registry = CosmosConversationClientRegistry("https://example.documents.azure.com", "key", "db", max_clients=2)
+
+    first = registry.get_client("first")
+    registry.get_client("second")
+    assert registry.get_client("first") is first
+    registry.get_client("third")
+
+    assert list(registry.clients) == [("db", "first"), ("db", "third")]
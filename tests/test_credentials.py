@@ -0,0 +1,81 @@
+import asyncio
+import time
+import pytest
+from azure.core.credentials import AccessToken
+from backend.auth.credentials import CredentialManager
+
+
+class DummyCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return AccessToken(f"token-{self.calls}", int(time.time()) + self.lifetime)
+
+
+@pytest.mark.asyncio
+async def test_get_token_is_cached():
+    credential = DummyCredential()
+    manager = CredentialManager(default_credential=credential)
+
+    first = await manager.get_token("scope")
+    second = await manager.get_token("scope")
+    assert first.token == second.token == "token-1"
+    assert credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_refreshes_are_coalesced():
+    credential = DummyCredential()
+    manager = CredentialManager(default_credential=credential)
+
+    tokens = await asyncio.gather(*[manager.get_token("scope") for _ in range(10)])
+    assert {token.token for token in tokens} == {"token-1"}
+    assert credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_expiring_token_is_refreshed():
+    credential = DummyCredential(lifetime=0)
+    manager = CredentialManager(default_credential=credential)
+
+    await manager.get_token("scope")
+    token = await manager.get_token("scope")
+    assert token.token == "token-2"
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_registered_credential_overrides_default():
+    default_credential = DummyCredential()
+    graph_credential = DummyCredential()
+    manager = CredentialManager(default_credential=default_credential)
+    manager.register("graph", graph_credential)
+
+    await manager.get_token("graph")
+    assert graph_credential.calls == 1
+    assert default_credential.calls == 0
+
+    provider = manager.get_bearer_token_provider("aoai")
+    assert await provider() == "token-1"
+    assert default_credential.calls == 1
+    await manager.close()
+
+
+@pytest.mark.asyncio
+async def test_start_prefetches_token():
+    credential = DummyCredential()
+    manager = CredentialManager(default_credential=credential)
+
+    manager.start("graph")
+    await asyncio.sleep(0.05)
+    assert credential.calls == 1
+    token = await manager.get_token("graph")
+    assert token.token == "token-1"
+    assert credential.calls == 1
+    await manager.close()
@@ -0,0 +1,22 @@
+import pytest
+from backend.http_clients import HttpClientPool
+
+
+@pytest.mark.asyncio
+async def test_one_client_per_host():
+    pool = HttpClientPool()
+    graph = pool.get_client("https://graph.microsoft.com/v1.0/me")
+    assert pool.get_client("https://graph.microsoft.com/v1.0/users") is graph
+    assert pool.get_client("https://example.com/score") is not graph
+    await pool.close()
+    assert graph.is_closed
+    assert pool.clients == {}
+
+
+@pytest.mark.asyncio
+async def test_per_host_timeout():
+    pool = HttpClientPool(timeout=5.0)
+    pool.configure("https://example.com/score", timeout=120.0)
+    assert pool.get_client("https://example.com/other").timeout.read == 120.0
+    assert pool.get_client("https://graph.microsoft.com/v1.0").timeout.read == 5.0
+    await pool.close()
@@ -0,0 +1,88 @@
+import time
+
+import pytest
+from backend.history.listcache import ConversationListCache, LocalListCacheBackend
+
+
+class FailingBackend:
+    async def get_generation(self, key):
+        raise ConnectionError("unavailable")
+
+    async def get(self, key, generation, field):
+        raise ConnectionError("unavailable")
+
+    async def set(self, key, generation, field, value, ttl):
+        raise ConnectionError("unavailable")
+
+    async def invalidate(self, key, ttl):
+        raise ConnectionError("unavailable")
+
+
+async def cache_page(cache, container_name, user_id, page, value):
+    generation = await cache.generation(container_name, user_id)
+    await cache.set(container_name, user_id, generation, page, value)
+
+
+async def cached_page(cache, container_name, user_id, page):
+    generation = await cache.generation(container_name, user_id)
+    return await cache.get(container_name, user_id, generation, page)
+
+
+@pytest.mark.asyncio
+async def test_pages_are_invalidated_per_user():
+    cache = ConversationListCache(LocalListCacheBackend())
+    page = {"conversations": [{"id": "conv-1"}], "next_cursor": "abc"}
+    await cache_page(cache, "conversations", "user-1", "cursor:", page)
+    await cache_page(cache, "conversations", "user-1", "cursor:abc", page)
+    await cache_page(cache, "conversations", "user-2", "cursor:", page)
+    await cache_page(cache, "other", "user-1", "cursor:", page)
+
+    assert await cached_page(cache, "conversations", "user-1", "cursor:abc") == page
+    await cache.invalidate("conversations", "user-1")
+    assert await cached_page(cache, "conversations", "user-1", "cursor:") is None
+    assert await cached_page(cache, "conversations", "user-1", "cursor:abc") is None
+    assert await cached_page(cache, "conversations", "user-2", "cursor:") == page
+    assert await cached_page(cache, "other", "user-1", "cursor:") == page
+
+    await cache_page(cache, "conversations", "user-1", "cursor:", page)
+    assert await cached_page(cache, "conversations", "user-1", "cursor:") == page
+
+
+@pytest.mark.asyncio
+async def test_page_loaded_across_an_invalidation_is_not_stored():
+    cache = ConversationListCache(LocalListCacheBackend())
+    generation = await cache.generation("conversations", "user-1")
+    await cache.invalidate("conversations", "user-1")
+    await cache.set("conversations", "user-1", generation, "cursor:", {"conversations": [], "next_cursor": None})
+
+    assert await cached_page(cache, "conversations", "user-1", "cursor:") is None
+
+
+@pytest.mark.asyncio
+async def test_pages_expire():
+    cache = ConversationListCache(LocalListCacheBackend(), ttl=0)
+    await cache_page(cache, "conversations", "user-1", "cursor:", {"conversations": [], "next_cursor": None})
+    assert await cached_page(cache, "conversations", "user-1", "cursor:") is None
+
+
+@pytest.mark.asyncio
+async def test_pages_expire_individually(monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache = ConversationListCache(LocalListCacheBackend(), ttl=30)
+    await cache_page(cache, "conversations", "user-1", "cursor:", {"conversations": [], "next_cursor": "abc"})
+
+    now += 20
+    await cache_page(cache, "conversations", "user-1", "cursor:abc", {"conversations": [], "next_cursor": None})
+    now += 20
+    assert await cached_page(cache, "conversations", "user-1", "cursor:") is None
+    assert await cached_page(cache, "conversations", "user-1", "cursor:abc") is not None
+
+
+@pytest.mark.asyncio
+async def test_backend_errors_are_misses():
+    cache = ConversationListCache(FailingBackend())
+    assert await cache.generation("conversations", "user-1") is None
+    await cache.set("conversations", "user-1", 0, "cursor:", {"conversations": [], "next_cursor": None})
+    assert await cache.get("conversations", "user-1", 0, "cursor:") is None
+    await cache.invalidate("conversations", "user-1")
@@ -0,0 +1,97 @@
+import dataclasses
+import json
+from datetime import datetime, timezone
+
+import pytest
+from quart import Quart, jsonify
+
+from backend import serialization
+from backend.serialization import FastJSONProvider, dumps
+
+
+@dataclasses.dataclass
+class Citation:
+    title: str
+    chunk_id: int
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dumps_encodes_dataclasses(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(serialization, "orjson", None)
+    elif serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+
+    payload = {"citations": [Citation("doc", 1)], "text": "grüße"}
+    assert json.loads(dumps(payload)) == {"citations": [{"title": "doc", "chunk_id": 1}], "text": "grüße"}
+
+
+def test_dumps_falls_back_for_large_integers():
+    assert json.loads(dumps({"value": 2 ** 70})) == {"value": 2 ** 70}
+
+
+def test_dumps_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        dumps({"value": object()})
+
+
+@pytest.mark.asyncio
+async def test_provider_matches_default_provider():
+    app = Quart(__name__)
+    default_provider = app.json
+    app.json = FastJSONProvider(app)
+
+    payload = {
+        "b": [Citation("doc", 1)],
+        "a": datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+        "c": "grüße",
+    }
+    assert json.loads(app.json.dumps(payload)) == json.loads(default_provider.dumps(payload))
+    assert list(json.loads(app.json.dumps(payload))) == ["a", "b", "c"]
+
+    async with app.app_context():
+        response = app.json.response(payload)
+    assert json.loads(await response.get_data()) == json.loads(default_provider.dumps(payload))
+
+
+class CountingOrjson:
+    def __init__(self, orjson):
+        self.orjson = orjson
+        self.calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self.orjson, name)
+
+    def dumps(self, *args, **kwargs):
+        self.calls += 1
+        return self.orjson.dumps(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("debug", [False, True])
+async def test_jsonify_is_encoded_with_orjson(monkeypatch, debug):
+    if serialization.orjson is None:
+        pytest.skip("orjson is not installed")
+    payload = {"b": "grüße", "a": [1, 2]}
+    layout = {"indent": 2} if debug else {"separators": (",", ":")}
+    expected = json.dumps(payload, sort_keys=True, ensure_ascii=False, **layout) + "\n"
+
+    counting = CountingOrjson(serialization.orjson)
+    monkeypatch.setattr(serialization, "orjson", counting)
+    monkeypatch.setattr(serialization.json, "dumps", None)
+
+    app = Quart(__name__)
+    app.debug = debug
+    app.json = FastJSONProvider(app)
+    async with app.app_context():
+        response = jsonify(payload)
+    body = (await response.get_data()).decode("utf-8")
+
+    assert counting.calls == 1
+    assert body == expected
+
+
+@pytest.mark.parametrize("text", ['grüße "👋" \\u00fc', "東京 \\\\x41 \\U0001f44b é\\", "\xa0\uffff\U0010ffff"])
+def test_escape_non_ascii_matches_the_stdlib(text):
+    encoded = json.dumps({"text": text}, ensure_ascii=False).encode("utf-8")
+    assert serialization.escape_non_ascii(encoded).decode("ascii") == json.dumps({"text": text})
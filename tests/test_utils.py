@@ -1,5 +1,21 @@
+import asyncio
+import base64
+import json
+import time
+from types import SimpleNamespace
+import httpx
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend import serialization
+from backend.cache import TTLCache
+from backend.utils import (
+    fetchUserGroups,
+    format_as_ndjson,
+    format_stream_response,
+    generateFilterString,
+    get_token_expiry,
+    parse_multi_columns,
+    redact_secrets,
+)
 
 
 @pytest.mark.asyncio
@@ -8,7 +24,8 @@ async def test_format_as_ndjson():
         yield {"message": "test message\n"}
 
     async for event in format_as_ndjson(dummy_generator()):
-        assert event == '{"message": "test message\\n"}\n'
+        assert event.endswith("\n")
+        assert json.loads(event) == {"message": "test message\n"}
 
 
 @pytest.mark.asyncio
@@ -18,7 +35,7 @@ async def test_format_as_ndjson_exception():
         yield {"message": "test message\n"}
     
     async for event in format_as_ndjson(dummy_generator()):
-        assert event == '{"error": "test exception"}'
+        assert json.loads(event) == {"error": "test exception"}
 
 def test_parse_multi_columns():
     test_pipes = "col1|col2|col3"
@@ -27,3 +44,219 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def make_token(exp):
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def graph_client(pages, calls):
+    def handler(request):
+        calls.append(str(request.url))
+        return httpx.Response(200, json=pages[len(calls) - 1])
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_follows_next_links():
+    calls = []
+    client = graph_client(
+        [
+            {"value": [{"id": "g1"}], "@odata.nextLink": "https://graph.microsoft.com/v1.0/next"},
+            {"value": [{"id": "g2"}]},
+        ],
+        calls,
+    )
+    groups = await fetchUserGroups("token", client)
+    assert groups == [{"id": "g1"}, {"id": "g2"}]
+    assert calls[1] == "https://graph.microsoft.com/v1.0/next"
+
+
+@pytest.mark.asyncio
+async def test_generate_filter_string_is_cached_per_token():
+    calls = []
+    client = graph_client([{"value": [{"id": "g1"}, {"id": "g2"}]}], calls)
+    filter_cache = TTLCache()
+    token = make_token(int(time.time()) + 3600)
+
+    first = await generateFilterString(token, client, filter_cache=filter_cache)
+    second = await generateFilterString(token, client, filter_cache=filter_cache)
+    assert first == second
+    assert first.endswith("/any(g:search.in(g, 'g1, g2'))")
+    assert len(calls) == 1
+
+
+
+@pytest.mark.asyncio
+async def test_generate_filter_string_uses_an_empty_group_cache():
+    calls = []
+    client = graph_client([{"value": [{"id": "g1"}]}], calls)
+    group_cache = TTLCache()
+
+    first = await generateFilterString("token", client, group_cache=group_cache, cache_key="user-1")
+    second = await generateFilterString("token", client, group_cache=group_cache, cache_key="user-1")
+    assert first == second
+    assert len(calls) == 1
+
+
+
+@pytest.mark.asyncio
+async def test_generate_filter_string_does_not_cache_throttled_lookups():
+    calls = []
+
+    def handler(request):
+        calls.append(str(request.url))
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "1"})
+        return httpx.Response(200, json={"value": [{"id": "g1"}]})
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    group_cache = TTLCache()
+
+    first = await generateFilterString("token", client, group_cache=group_cache, cache_key="user-1")
+    second = await generateFilterString("token", client, group_cache=group_cache, cache_key="user-1")
+    assert first.endswith("/any(g:search.in(g, ''))")
+    assert second.endswith("/any(g:search.in(g, 'g1'))")
+    assert len(calls) == 2
+    assert group_cache.get("user-1") == [{"id": "g1"}]
+
+
+def test_get_token_expiry():
+    assert get_token_expiry(make_token(1700000000)) == 1700000000
+    assert get_token_expiry("not-a-jwt") is None
+
+
+def test_redact_secrets():
+    data_source = {
+        "type": "azure_cosmos_db",
+        "parameters": {
+            "authentication": {"type": "connection_string", "connection_string": "mongodb://secret"},
+            "embedding_dependency": {"type": "endpoint", "authentication": {"type": "api_key", "key": "secret"}},
+            "fields_mapping": {"content_fields": ["content"]},
+            "filter": None,
+        },
+    }
+    redacted = redact_secrets({"data_sources": [data_source]})["data_sources"][0]["parameters"]
+    assert redacted["authentication"] == {"type": "connection_string", "connection_string": "*****"}
+    assert redacted["embedding_dependency"]["authentication"]["key"] == "*****"
+    assert redacted["fields_mapping"] == {"content_fields": ["content"]}
+    assert data_source["parameters"]["authentication"]["connection_string"] == "mongodb://secret"
+
+
+def delta(content):
+    return {"id": "chunk", "choices": [{"messages": [{"role": "assistant", "content": content}]}], "history_metadata": {}}
+
+
+def tool_frame(content="{}"):
+    return {"id": "chunk", "choices": [{"messages": [{"role": "tool", "content": content}]}], "history_metadata": {}}
+
+
+async def frames(generator):
+    return [json.loads(line) async for line in generator]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesces_deltas():
+    async def stream():
+        yield {}
+        yield tool_frame()
+        for token in ["Hello", " wor", "ld"]:
+            yield delta(token)
+        yield {}
+
+    result = await frames(format_as_ndjson(stream(), coalesce_interval_ms=1000))
+    assert result == [{}, tool_frame(), delta("Hello world"), {}]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_size_bound():
+    async def stream():
+        for token in ["ab", "cd", "ef", "g"]:
+            yield delta(token)
+
+    result = await frames(format_as_ndjson(stream(), coalesce_interval_ms=1000, coalesce_max_bytes=4))
+    assert result == [delta("abcd"), delta("efg")]
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_time_bound():
+    async def stream():
+        yield delta("fast")
+        await asyncio.sleep(0.1)
+        yield delta("slow")
+
+    started = time.monotonic()
+    arrivals = []
+    async for line in format_as_ndjson(stream(), coalesce_interval_ms=20):
+        arrivals.append((time.monotonic() - started, json.loads(line)))
+
+    assert [frame for _, frame in arrivals] == [delta("fast"), delta("slow")]
+    # the first frame is not held back until the next delta arrives
+    assert arrivals[0][0] < 0.09
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_coalesce_flushes_before_error():
+    async def stream():
+        yield delta("partial")
+        raise ValueError("stream failed")
+
+    lines = [line async for line in format_as_ndjson(stream(), coalesce_interval_ms=1000)]
+    assert json.loads(lines[0]) == delta("partial")
+    assert json.loads(lines[1]) == {"error": "stream failed"}
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_v2_sends_envelope_once():
+    history_metadata = {"conversation_id": "c1", "title": "local"}
+
+    async def stream():
+        yield {}
+        yield {**tool_frame({"citations": []}), "model": "gpt", "created": 1, "object": "chat.completion.chunk", "history_metadata": history_metadata}
+        yield {**delta("Hello"), "history_metadata": history_metadata}
+        history_metadata["title"] = "generated"
+        yield {**delta(" world"), "history_metadata": history_metadata}
+
+    result = await frames(format_as_ndjson(stream(), stream_version=2))
+    assert result == [
+        {
+            "v": 2,
+            "id": "chunk",
+            "model": "gpt",
+            "created": 1,
+            "object": "chat.completion.chunk",
+            "history_metadata": {"conversation_id": "c1", "title": "local"},
+        },
+        {"citations": {"citations": []}},
+        {"delta": "Hello"},
+        {"history_metadata": {"conversation_id": "c1", "title": "generated"}},
+        {"delta": " world"},
+    ]
+
+
+@pytest.mark.parametrize("stream_version", [1, 2])
+def test_format_stream_response_encodes_citations_for_v1_only(stream_version):
+    context = {"citations": [{"title": "doc"}]}
+    chunk = SimpleNamespace(
+        id="chunk", model="gpt", created=1, object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=SimpleNamespace(role="assistant", content=None, context=context))],
+    )
+
+    message = format_stream_response(chunk, {}, stream_version=stream_version)["choices"][0]["messages"][0]
+    assert message["role"] == "tool"
+    assert message["content"] == (context if stream_version == 2 else json.dumps(context, separators=(",", ":")))
+
+
+@pytest.mark.asyncio
+async def test_format_as_ndjson_escapes_non_ascii(monkeypatch):
+    async def stream():
+        yield delta("grüße 👋")
+
+    expected = json.dumps(delta("grüße 👋"), separators=(",", ":"))
+    if serialization.orjson:
+        ## non-ASCII frames are escaped, not encoded a second time by the stdlib
+        monkeypatch.setattr(serialization.json, "dumps", None)
+    lines = [line async for line in format_as_ndjson(stream())]
+    assert lines == [expected + "\n"]
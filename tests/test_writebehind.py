@@ -0,0 +1,91 @@
+import pytest
+from azure.cosmos import exceptions
+from backend.history.writebehind import HistoryWriteQueue
+
+
+class FakeContainer:
+    def __init__(self, throttle=0, fail_ids=(), missing_ids=()):
+        self.throttle = throttle
+        self.fail_ids = set(fail_ids)
+        self.missing_ids = set(missing_ids)
+        self.batches = []
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        if self.throttle:
+            self.throttle -= 1
+            error = exceptions.CosmosHttpResponseError(status_code=429, message="throttled")
+            error.headers = {"x-ms-retry-after-ms": "1"}
+            raise error
+
+        ids = {operation[1][0]["id"] for operation in batch_operations if operation[0] == "upsert"}
+        if ids & self.fail_ids:
+            raise exceptions.CosmosBatchOperationError(
+                error_index=0, headers={}, status_code=400, message="failed", operation_responses=[]
+            )
+
+        for index, operation in enumerate(batch_operations):
+            if operation[0] == "patch" and operation[1][0] in self.missing_ids:
+                raise exceptions.CosmosBatchOperationError(
+                    error_index=index,
+                    headers={},
+                    status_code=404,
+                    message="not found",
+                    operation_responses=[{"statusCode": 424}] * index + [{"statusCode": 404}],
+                )
+
+        self.batches.append((partition_key, batch_operations))
+        return batch_operations
+
+
+def upsert(item_id):
+    return [("upsert", ({"id": item_id},))]
+
+
+@pytest.mark.asyncio
+async def test_writes_are_batched_per_partition():
+    container = FakeContainer()
+    queue = HistoryWriteQueue(flush_interval=0.01)
+    queue.enqueue(container, "user-1", upsert("a"))
+    queue.enqueue(container, "user-2", upsert("b"))
+    queue.enqueue(container, "user-1", upsert("c"))
+    assert queue.depth == 3
+
+    await queue.close()
+    assert queue.depth == 0
+    batches = dict(container.batches)
+    assert batches["user-1"] == upsert("a") + upsert("c")
+    assert batches["user-2"] == upsert("b")
+
+
+@pytest.mark.asyncio
+async def test_throttled_batch_is_retried():
+    container = FakeContainer(throttle=2)
+    queue = HistoryWriteQueue(flush_interval=0)
+    queue.enqueue(container, "user-1", upsert("a"))
+
+    await queue.close()
+    assert container.batches == [("user-1", upsert("a"))]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_is_retried_per_write():
+    container = FakeContainer(fail_ids=["bad"])
+    queue = HistoryWriteQueue(flush_interval=0.01)
+    queue.enqueue(container, "user-1", upsert("a"))
+    queue.enqueue(container, "user-1", upsert("bad"))
+    queue.enqueue(container, "user-1", upsert("c"))
+
+    await queue.close()
+    assert container.batches == [("user-1", upsert("a")), ("user-1", upsert("c"))]
+    assert (queue.dropped, queue.dropped_not_found) == (1, 0)
+
+
+@pytest.mark.asyncio
+async def test_write_of_a_deleted_conversation_is_counted():
+    container = FakeContainer(missing_ids=["deleted"])
+    queue = HistoryWriteQueue(flush_interval=0)
+    queue.enqueue(container, "user-1", upsert("msg") + [("patch", ("deleted", []))])
+
+    await queue.close()
+    assert container.batches == []
+    assert (queue.dropped, queue.dropped_not_found) == (1, 1)